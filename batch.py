@@ -0,0 +1,227 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Headless batch mode: load, split, trim, crop, border and export decks
+from the command line or from a recipe file, without opening a window.
+
+A recipe is a JSON file like:
+
+	{"steps": [["split", 3, 3, 10], ["trim", 20], ["crop", {"top": 5}], ["borders", "black", 4]],
+	 "output": {"format": "pdf", "card_size": "Poker", "paper_size": "A4", "colors": "gray"},
+	 "sets": [{"inputs": ["base.pdf"], "pages": "1-9", "dpi": 200, "output": {"path": "base"}},
+	          {"inputs": ["expansion.pdf", "promo.png"], "output": {"path": "expansion"}}]}
+
+Every step is a Deck operation followed by its arguments, with keyword
+arguments in a trailing object; ["auto_split"] splits every sheet by the
+grid found on it. Sets inherit the top level steps and
+output unless they override them. Pages and dpi are optional, by default
+every page is loaded at the resolution the card size will print at.
+Output colors is color, gray or lineart; print_dpi (300 by default, 0
+keeps every pixel) is what cards are shrunk to on paper. Separated images
+take image_format (png or jpg) and quality.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+from multiprocessing import cpu_count
+
+from store import CardStore
+from export import StreamPrinter, card_size_text, COLORS, DPI
+from writer import ImageWriter, FORMATS as IMAGE_FORMATS
+import parallel
+import ingest
+import cache
+import profiling
+
+FORMATS = {"pdf": "Pdf from images", "grid": "Pdf from grid", "images": "Separated images"}
+
+#Only what needs a QApplication (pdf painting) gets one
+def application():
+	from PyQt4.QtGui import QApplication
+	if QApplication.instance() is None:
+		application.app = QApplication(sys.argv, False)
+	return QApplication.instance()
+
+def step(raw):
+	op, args = raw[0], list(raw[1:])
+	kwargs = args.pop() if args and isinstance(args[-1], dict) else {}
+	return op, tuple(args), kwargs
+
+#sheets is a folder to keep the encoded cards in, for the next export to reuse
+def export(deck, output, call=None, use_pool=False, sheets=None):
+	format = FORMATS.get(output.get("format", "pdf"), output.get("format"))
+	path = output["path"]
+	if format == "Separated images":
+		writer = ImageWriter()
+		writer.config(deck = deck, print_path = path, format = output.get("image_format", "png"),
+				quality = output.get("quality"), parallel = use_pool)
+		writer.print_images(call)
+		return
+	application()
+	printer = StreamPrinter()
+	printer.config(deck = deck, paper_size = output.get("paper_size", "A4"),
+			orientation = output.get("orientation", "Portrait"), print_path = path + ".pdf",
+			dpi = output.get("print_dpi", DPI), colors = output.get("colors", "color"),
+			sheets = sheets, parallel = use_pool)
+	if format == "Pdf from images":
+		printer.config(card_size = card_size_text(output.get("card_size", "Poker")))
+		printer.print_pdf(call)
+	elif format == "Pdf from grid":
+		printer.print_grid(call)
+	else:
+		raise ValueError("Unknown output format %r" % format)
+
+#None when the grid is found on every sheet
+def split_size(steps):
+	for raw in steps:
+		op, args, kwargs = step(raw)
+		if op == "split":
+			return args[0], args[1]
+		if op == "auto_split":
+			return None
+	return 1, 1
+
+#Loads the inputs and runs the steps, unless the disk cache already has
+#the cards they produce
+def process(deck, inputs, steps, output, use_pool=True, log=None, pages=None, dpi=None):
+	card_size = card_size_text(output.get("card_size", "Poker"))
+	disk = cache.shared()
+	key = None if disk is None else disk.source_key(inputs, "recipe", pages, dpi, card_size, steps)
+	found = None if disk is None else disk.get(key)
+	if found is not None:
+		for blob, size in disk.cards(found):
+			deck.add_blob(blob, None, size)
+		if log is not None:
+			log("%s: %d cards from cache" % (output["path"], len(deck)))
+		return
+	grid = split_size(steps)
+	for file in inputs:
+		deck.load(file, pages, dpi or (ingest.target_dpi(file, card_size, *grid) if grid else ingest.PRINT_DPI))
+	if log is not None:
+		log("%s: %d cards loaded" % (output["path"], len(deck)))
+	for raw in steps:
+		op, args, kwargs = step(raw)
+		parallel.run(deck, op, args, kwargs, None, use_pool)
+	if disk is not None:
+		deck.bake_all()
+		disk.put(key, ((deck.blob(num), deck.meta[num]["size"]) for num in range(len(deck))))
+
+def run_set(inputs, steps, output, use_pool=True, log=None, pages=None, dpi=None):
+	deck = CardStore()
+	try:
+		process(deck, inputs, steps, output, use_pool, log, pages, dpi)
+		export(deck, output, None, use_pool)
+		if log is not None:
+			log("%s: %d cards exported" % (output["path"], len(deck)))
+	finally:
+		deck.close()
+
+def sets(recipe):
+	for entry in recipe.get("sets", [recipe]):
+		output = dict(recipe.get("output", {}))
+		output.update(entry.get("output", {}))
+		yield (entry["inputs"], entry.get("steps", recipe.get("steps", [])), output,
+				entry.get("pages", recipe.get("pages")), entry.get("dpi", recipe.get("dpi")))
+
+def run_recipe(recipe, use_pool=True, log=None):
+	for inputs, steps, output, pages, dpi in sets(recipe):
+		run_set(inputs, steps, output, use_pool, log, pages, dpi)
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description="Print and play cards without the window")
+	parser.add_argument("inputs", nargs="*", help="images or pdf files")
+	parser.add_argument("-r", "--recipe", help="JSON recipe file, flags below are ignored")
+	parser.add_argument("-o", "--output", default="cards", help="output path, without .pdf")
+	parser.add_argument("--each", action="store_true", help="process every input on its own, output becomes a folder")
+	parser.add_argument("--pages", help="pdf pages to load, like 1-3,7")
+	parser.add_argument("--dpi", type=int, help="pdf resolution, by default what the card size needs")
+	parser.add_argument("--split", metavar="NxM", help="rows x columns of every sheet, or auto to find them on each")
+	parser.add_argument("--sep", type=int, default=0, help="interspace between cards in px")
+	parser.add_argument("--remove-borders", action="store_true")
+	parser.add_argument("--trim", type=int, metavar="FUZZ")
+	parser.add_argument("--crop", type=int, metavar="PX", help="crop every side")
+	for side in ("top", "right", "bottom", "left"):
+		parser.add_argument("--crop-" + side, type=int, metavar="PX")
+	parser.add_argument("--border", choices=["black", "white"])
+	parser.add_argument("--border-width", type=int, default=5)
+	parser.add_argument("--format", choices=sorted(FORMATS), default="pdf")
+	parser.add_argument("--card-size", default="Poker")
+	parser.add_argument("--paper-size", default="A4")
+	parser.add_argument("--orientation", choices=["Portrait", "Landscape"], default="Portrait")
+	parser.add_argument("--image-format", choices=IMAGE_FORMATS, default="png", help="of separated images")
+	parser.add_argument("--quality", type=int, help="jpg quality, 1-100")
+	parser.add_argument("--print-dpi", type=int, default=DPI, help="shrink cards to this resolution on paper, 0 keeps them")
+	parser.add_argument("--colors", choices=COLORS, default="color", help="gray and lineart are stored lossless")
+	parser.add_argument("--serial", action="store_true", help="don't use a process per core")
+	parser.add_argument("--profile", action="store_true", help="print where the time of every set went")
+	parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace of every operation")
+	return parser.parse_args(argv)
+
+def recipe_from_args(args):
+	steps = []
+	if args.split == "auto":
+		steps.append(["auto_split"])
+	elif args.split:
+		n, m = [int(el) for el in args.split.lower().split("x")]
+		steps.append(["split", n, m, args.sep])
+	if args.remove_borders:
+		steps.append(["del_borders"])
+	if args.trim is not None:
+		steps.append(["trim", args.trim])
+	sides = {}
+	for side in ("top", "right", "bottom", "left"):
+		px = getattr(args, "crop_" + side)
+		px = args.crop if px is None else px
+		if px:
+			sides[side] = px
+	if sides:
+		steps.append(["crop", sides])
+	if args.border:
+		steps.append(["borders", args.border, args.border_width])
+	output = {"path": args.output, "format": args.format, "card_size": args.card_size,
+			"paper_size": args.paper_size, "orientation": args.orientation,
+			"print_dpi": args.print_dpi, "colors": args.colors,
+			"image_format": args.image_format, "quality": args.quality}
+	if not args.each:
+		return {"steps": steps, "output": output, "pages": args.pages, "dpi": args.dpi,
+				"sets": [{"inputs": args.inputs}]}
+	if not os.path.isdir(args.output):
+		os.makedirs(args.output)
+	name = lambda file: os.path.join(args.output, os.path.splitext(os.path.basename(file))[0])
+	return {"steps": steps, "output": output, "pages": args.pages, "dpi": args.dpi,
+			"sets": [{"inputs": [file], "output": {"path": name(file)}} for file in args.inputs]}
+
+def main(argv):
+	args = parse_args(argv)
+	if args.recipe:
+		with open(args.recipe) as f:
+			recipe = json.load(f)
+	elif args.inputs:
+		recipe = recipe_from_args(args)
+	else:
+		print("Nothing to do, give some input files or a recipe", file=sys.stderr)
+		return 2
+	profiler = profiling.install() if args.profile or args.trace else None
+	use_pool = not args.serial and cpu_count() > 1
+	try:
+		for inputs, steps, output, pages, dpi in sets(recipe):
+			mark = profiler.mark() if profiler is not None else 0
+			run_set(inputs, steps, output, use_pool, lambda text: print(text), pages, dpi)
+			if args.profile:
+				print("  " + profiler.summary(mark, 5))
+	finally:
+		if args.trace:
+			profiler.write(args.trace)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
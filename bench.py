@@ -0,0 +1,296 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Benchmarks of the Deck and Printer hot paths on synthetic decks. Fixtures
+(card images and 3x3 sheet pdfs) are generated locally for every deck size
+and dpi. Every measurement runs in a process of its own so its peak RSS is
+its own, and is printed as one JSON object per line:
+
+	{"op": "trim", "target": "deck", "cards": 100, "dpi": 300, "seconds": 4.2,
+	 "cards_per_second": 23.8, "peak_rss_kb": 412000, "rss_growth_kb": 1200,
+	 "workers_peak_rss_kb": 98000}
+
+workers_peak_rss_kb is the peak of the biggest process pool worker (pdf
+pages, trims and encodes run in pools), null when there was none.
+
+Targets are pnp's Deck and Printer, and this program's CardStore,
+StreamPrinter and ImageWriter. CardStore defers its edits, so its timings
+include reading back every card, rendered. The disk cache is off while benchmarking.
+
+The startup target (not run by default, it needs a display) starts the
+window a few times and keeps the quickest time to a usable window:
+
+	{"op": "startup", "target": "startup", "seconds": 0.41, "imports_seconds": 0.12,
+	 "window_seconds": 0.35, "heavy": [], "peak_rss_kb": 61000}
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+SIZES = [10, 100, 1000]
+DPIS = [150, 300]
+#Poker cards, inches
+CARD = (2.5, 3.5)
+SHEET = (3, 3)
+SEP = 10
+STARTUP_RUNS = 5
+
+DECK_OPS = ["load", "split", "join", "trim", "crop", "borders", "del_borders"]
+PRINT_OPS = ["print_pdf", "print_grid", "print_images", "preview_card"]
+TARGETS = {"deck": DECK_OPS + PRINT_OPS, "store": DECK_OPS + ["stream_pdf", "stream_grid", "write_images"],
+		"startup": ["startup"]}
+DEFAULT_TARGETS = ["deck", "store"]
+
+def card_px(dpi):
+	return int(CARD[0]*dpi), int(CARD[1]*dpi)
+
+#A white card with a coloured frame and some blocks, so trim has work to do
+def make_card(num, dpi):
+	from wand.image import Image
+	from wand.color import Color
+	from wand.drawing import Drawing
+	width, height = card_px(dpi)
+	img = Image(width=width, height=height, background=Color("white"))
+	margin = width//20
+	with Drawing() as draw:
+		draw.fill_color = Color("#%02x%02x%02x" % ((num*37) % 256, (num*91) % 256, (num*53) % 256))
+		draw.rectangle(left=margin, top=margin, right=width-margin, bottom=height-margin)
+		draw.fill_color = Color("black")
+		for block in range(5):
+			top = margin*2 + block*(height - margin*4)//5
+			draw.rectangle(left=margin*2, top=top, right=width-margin*2, bottom=top+margin)
+		draw(img)
+	return img
+
+def make_sheet(first, count, dpi):
+	from wand.image import Image
+	from wand.color import Color
+	width, height = card_px(dpi)
+	n, m = SHEET
+	sheet = Image(width=m*width + (m-1)*SEP, height=n*height + (n-1)*SEP, background=Color("white"))
+	for slot in range(count):
+		row, col = divmod(slot, m)
+		with make_card(first + slot, dpi) as card:
+			sheet.composite(card, left=col*(width+SEP), top=row*(height+SEP))
+	return sheet
+
+#Folder with card images and sheets.pdf, generated once per size and dpi
+def fixtures(root, size, dpi):
+	from wand.image import Image
+	folder = os.path.join(root, "%d-%d" % (size, dpi))
+	done = os.path.join(folder, "done")
+	if os.path.exists(done):
+		return folder
+	if not os.path.isdir(folder):
+		os.makedirs(folder)
+	for num in range(size):
+		with make_card(num, dpi) as card:
+			card.save(filename=os.path.join(folder, "card-%05d.png" % num))
+	per_sheet = SHEET[0]*SHEET[1]
+	with Image() as pdf:
+		for first in range(0, size, per_sheet):
+			with make_sheet(first, min(per_sheet, size - first), dpi) as sheet:
+				pdf.sequence.append(sheet)
+		pdf.resolution = (dpi, dpi)
+		pdf.save(filename=os.path.join(folder, "sheets.pdf"))
+	open(done, "w").close()
+	return folder
+
+def card_files(folder):
+	return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".png"))
+
+def application():
+	from PyQt4.QtGui import QApplication
+	return QApplication(sys.argv, bool(os.environ.get("DISPLAY")))
+
+def new_deck(target):
+	if target == "store":
+		from store import CardStore
+		return CardStore()
+	from pnp import Deck
+	return Deck([])
+
+def loaded(target, folder, dpi, sheets=False):
+	deck = new_deck(target)
+	if sheets:
+		if target == "store":
+			deck.load(os.path.join(folder, "sheets.pdf"), None, dpi)
+		else:
+			deck.load(os.path.join(folder, "sheets.pdf"))
+	else:
+		for file in card_files(folder):
+			deck.load(file)
+	return deck
+
+#Reading every card back makes CardStore do the work it deferred
+def settle(deck):
+	if hasattr(deck, "meta"):
+		for num in range(len(deck)):
+			deck[num]
+
+#Returns the function to time; everything before it is setup
+def prepare(op, target, folder, dpi, out):
+	from pnp import Border
+	if op == "load":
+		return lambda: settle(loaded(target, folder, dpi, True))
+	n, m = SHEET
+	deck = loaded(target, folder, dpi, op == "split")
+	ops = {
+		"split": lambda: deck.split(n, m, SEP),
+		"join": lambda: deck.join(n, m, SEP),
+		"trim": lambda: deck.trim(20),
+		"crop": lambda: deck.crop(top=10, right=10, bottom=10, left=10),
+		"borders": lambda: deck.borders(Border.black, 10),
+		"del_borders": lambda: deck.del_borders(),
+	}
+	if op in ops:
+		run = ops[op]
+		def timed():
+			run()
+			settle(deck)
+		return timed
+	if op == "write_images":
+		from writer import ImageWriter
+		writer = ImageWriter()
+		writer.config(deck = deck, print_path = os.path.join(out, "images"), parallel = True)
+		return writer.print_images
+	application()
+	if op.startswith("stream_"):
+		from export import StreamPrinter, CARD_SIZES
+		printer = StreamPrinter()
+		printer.config(deck = deck, card_size = CARD_SIZES[3], paper_size = "A4",
+				print_path = os.path.join(out, op + ".pdf"))
+		return printer.print_pdf if op == "stream_pdf" else printer.print_grid
+	from pnp import Printer
+	printer = Printer()
+	if op == "preview_card":
+		if not os.environ.get("DISPLAY"):
+			raise RuntimeError("preview_card needs a display")
+		return lambda: [printer.preview_card(deck[num]) for num in range(len(deck))]
+	if op == "print_images":
+		images = os.path.join(out, "images")
+		os.makedirs(images)
+		printer.config(deck = deck, print_path = images)
+	elif op == "print_pdf":
+		from export import CARD_SIZES
+		printer.config(deck = deck, card_size = CARD_SIZES[3], paper_size = "A4",
+				print_path = os.path.join(out, op + ".pdf"))
+	else:
+		printer.config(deck = deck, orientation = "Portrait", paper_size = "A4",
+				print_path = os.path.join(out, op + ".pdf"))
+	return getattr(printer, op)
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+	return resource.getrusage(who).ru_maxrss
+
+def measure(queue, op, target, folder, size, dpi):
+	out = tempfile.mkdtemp(prefix="pnp-bench-")
+	#Card stores of the child go to out too, and go away with it
+	tempfile.tempdir = out
+	try:
+		run = prepare(op, target, folder, dpi, out)
+		before = peak_rss_kb()
+		start = time.time()
+		run()
+		seconds = time.time() - start
+		queue.put({"op": op, "target": target, "cards": size, "dpi": dpi,
+				"seconds": round(seconds, 4), "cards_per_second": round(size/seconds, 2) if seconds else None,
+				"peak_rss_kb": peak_rss_kb(), "rss_growth_kb": peak_rss_kb() - before,
+				"workers_peak_rss_kb": peak_rss_kb(resource.RUSAGE_CHILDREN) or None})
+	except Exception as e:
+		queue.put({"op": op, "target": target, "cards": size, "dpi": dpi, "error": str(e)})
+	finally:
+		shutil.rmtree(out, True)
+
+#The window reports its own times (see pnp-cards.py); seconds is the
+#whole run, interpreter start and exit included
+def startup(runs=STARTUP_RUNS):
+	if not os.environ.get("DISPLAY"):
+		return {"op": "startup", "target": "startup", "error": "startup needs a display"}
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pnp-cards.py")
+	env = dict(os.environ, PNP_CARDS_STARTUP="1")
+	best = None
+	for run in range(runs):
+		start = time.time()
+		try:
+			output = subprocess.check_output([sys.executable, script], env=env)
+		except (OSError, subprocess.CalledProcessError) as e:
+			return {"op": "startup", "target": "startup", "error": str(e)}
+		result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+		result["seconds"] = round(time.time() - start, 4)
+		if best is None or result["window_seconds"] < best["window_seconds"]:
+			best = result
+	best.update({"op": "startup", "target": "startup",
+			"peak_rss_kb": peak_rss_kb(resource.RUSAGE_CHILDREN)})
+	del best["modules"]
+	return best
+
+def run_one(op, target, folder, size, dpi):
+	queue = Queue()
+	child = Process(target=measure, args=(queue, op, target, folder, size, dpi))
+	child.start()
+	child.join()
+	if queue.empty():
+		return {"op": op, "target": target, "cards": size, "dpi": dpi, "error": "exit code %s" % child.exitcode}
+	return queue.get()
+
+def results(args):
+	only = set(args.ops.split(",")) if args.ops else None
+	targets = args.targets.split(",")
+	if "startup" in targets:
+		targets.remove("startup")
+		yield startup()
+	if not targets:
+		return
+	for dpi in [int(el) for el in args.dpis.split(",")]:
+		for size in [int(el) for el in args.sizes.split(",")]:
+			folder = fixtures(args.fixtures, size, dpi)
+			for target in targets:
+				for op in TARGETS[target]:
+					if only is None or op in only:
+						yield run_one(op, target, folder, size, dpi)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="Benchmark Deck and Printer on synthetic decks")
+	parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="cards per deck, comma separated")
+	parser.add_argument("--dpis", default=",".join(map(str, DPIS)), help="comma separated")
+	parser.add_argument("--targets", default=",".join(DEFAULT_TARGETS), help="deck, store, startup")
+	parser.add_argument("--ops", help="only these operations, comma separated")
+	parser.add_argument("--fixtures", default=os.path.join(tempfile.gettempdir(), "pnp-bench-fixtures"))
+	parser.add_argument("-o", "--out", help="also append the results to this file")
+	args = parser.parse_args(argv)
+	#Cached pages would make every run after the first a cache benchmark
+	os.environ["PNP_CARDS_NO_CACHE"] = "1"
+	out = open(args.out, "a") if args.out else None
+	failed = False
+	try:
+		for result in results(args):
+			line = json.dumps(result, sort_keys=True)
+			failed = failed or '"error"' in line
+			print(line)
+			sys.stdout.flush()
+			if out is not None:
+				out.write(line + "\n")
+				out.flush()
+	finally:
+		if out is not None:
+			out.close()
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Persistent cache of encoded cards, shared between runs. Entries are keyed
+by the hash of the source files plus whatever produced the cards from
+them (page range, dpi, recipe steps), so an unchanged source with the same
+recipe is never rasterized or processed twice. Cards are stored deflated,
+at the fastest level: raw pages are mostly runs and compress several times
+over. The least recently used entries go once the cache grows past its
+size, and an entry that would be bigger than the whole cache is not kept.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+MAX_BYTES = 2*1024**3
+LEVEL = 1
+
+def cache_dir():
+	base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "pnp-cards")
+
+_hashes = {}
+
+#Hashes are remembered for as long as the file keeps its size and mtime
+def file_hash(path):
+	stat = os.stat(path)
+	known = (path, stat.st_size, stat.st_mtime)
+	if known not in _hashes:
+		digest = hashlib.sha1()
+		with open(path, "rb") as f:
+			for chunk in iter(lambda: f.read(1 << 20), b""):
+				digest.update(chunk)
+		_hashes[known] = digest.hexdigest()
+	return _hashes[known]
+
+class DiskCache(object):
+
+	def __init__(self, path=None, max_bytes=MAX_BYTES):
+		self.path = cache_dir() if path is None else path
+		self.max_bytes = max_bytes
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+
+	def key(self, *parts):
+		return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+	def source_key(self, files, *parts):
+		return self.key([file_hash(file) for file in files], *parts)
+
+	#[(path, size)] of the encoded cards, or None
+	def get(self, key):
+		folder = os.path.join(self.path, key)
+		try:
+			with open(os.path.join(folder, "index.json")) as f:
+				index = json.load(f)
+			os.utime(folder, None)
+		except (IOError, OSError, ValueError):
+			return None
+		return [(os.path.join(folder, name), tuple(size) if size else None) for name, size in index]
+
+	#(blob, size) of every card, read one at a time
+	def cards(self, found):
+		for path, size in found:
+			with open(path, "rb") as f:
+				blob = f.read()
+			yield (zlib.decompress(blob) if path.endswith(".z") else blob), size
+
+	def writer(self, key):
+		return CacheWriter(self, key)
+
+	def put(self, key, cards):
+		writer = self.writer(key)
+		for blob, size in cards:
+			writer.add(blob, size)
+		writer.commit()
+
+	def entries(self):
+		found = []
+		for name in os.listdir(self.path):
+			folder = os.path.join(self.path, name)
+			if name.startswith(".") or not os.path.isdir(folder):
+				continue
+			size = sum(os.path.getsize(os.path.join(folder, el)) for el in os.listdir(folder))
+			found.append((os.path.getmtime(folder), size, folder))
+		return sorted(found)
+
+	def evict(self):
+		entries = self.entries()
+		total = sum(size for mtime, size, folder in entries)
+		for mtime, size, folder in entries:
+			if total <= self.max_bytes:
+				break
+			shutil.rmtree(folder, True)
+			total -= size
+
+	def clear(self):
+		for mtime, size, folder in self.entries():
+			shutil.rmtree(folder, True)
+
+#Cards are written aside as they come and renamed into place on commit,
+#so readers never see half an entry. Once the entry outgrows the whole
+#cache it is dropped, and the rest of its cards aren't written.
+class CacheWriter(object):
+
+	def __init__(self, cache, key):
+		self.cache = cache
+		self.folder = os.path.join(cache.path, key)
+		self.tmp = tempfile.mkdtemp(dir=cache.path, prefix=".tmp-")
+		self.index = []
+		self.bytes = 0
+
+	def add(self, blob, size=None):
+		if self.tmp is None:
+			return
+		data = zlib.compress(blob, LEVEL)
+		self.bytes += len(data)
+		if self.bytes > self.cache.max_bytes:
+			self.abort()
+			return
+		name = "%06d.card.z" % len(self.index)
+		with open(os.path.join(self.tmp, name), "wb") as f:
+			f.write(data)
+		self.index.append((name, None if size is None else list(size)))
+
+	def commit(self):
+		if self.tmp is None:
+			return
+		with open(os.path.join(self.tmp, "index.json"), "w") as f:
+			json.dump(self.index, f)
+		try:
+			os.rename(self.tmp, self.folder)
+		except OSError:
+			self.abort()
+		self.tmp = None
+		self.cache.evict()
+
+	def abort(self):
+		if self.tmp is not None:
+			shutil.rmtree(self.tmp, True)
+			self.tmp = None
+
+_shared = []
+
+#None when PNP_CARDS_NO_CACHE is set
+def shared():
+	if os.environ.get("PNP_CARDS_NO_CACHE"):
+		return None
+	if not _shared:
+		try:
+			_shared.append(DiskCache())
+		except OSError:
+			_shared.append(None)
+	return _shared[0]
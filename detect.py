@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Content detection with numpy. Trims and border removals are measured with
+reductions over whole rows and columns and recorded as plain crops, which
+then fuse with the crops around them. Cards are rendered and measured in
+a process pool; only the crops come back to the deck.
+
+The grid of cards on a sheet is found the same way: rows and columns with
+(almost) no content are the margins and the gutters between cards, and
+the gutters that divide the content in equal cells give the rows, columns
+and interspace Deck.split takes.
+"""
+
+from multiprocessing import Pool, cpu_count
+
+from imaging import from_blob, to_array
+from edits import edit, render
+
+#Fuzz used to find borders of a single colour
+UNIFORM = 1
+#Cards on their way to the pool per process, so only a few are in memory
+WINDOW = 4
+#Fuzz telling cards from the sheet, and the share of a row or column that
+#may still have content and count as a gutter (dust, scan noise)
+GRID_FUZZ = 10
+GUTTER = 0.01
+MAX_CELLS = 12
+
+#numpy is imported the first time something is measured, not on startup
+numpy = None
+
+def available():
+	global numpy
+	if numpy is None:
+		try:
+			import numpy as module
+		except ImportError:
+			return False
+		numpy = module
+	return True
+
+#arr is (height, width, channels); the background is the colour of the
+#top left corner, as ImageMagick's trim does
+def content_box(arr, fuzz):
+	arr = numpy.asarray(arr, dtype=numpy.int16)
+	mask = numpy.abs(arr - arr[:1, :1, :]).max(axis=2) > fuzz*255/100.0
+	row, col = mask.any(axis=1), mask.any(axis=0)
+	if not row.any():
+		return {}
+	top, bottom = row.argmax(), row[::-1].argmax()
+	left, right = col.argmax(), col[::-1].argmax()
+	return dict((side, int(px)) for side, px in
+			zip(("top", "right", "bottom", "left"), (top, right, bottom, left)) if px)
+
+#Runs in the workers
+def _box(task):
+	blob, edits, fuzz = task
+	available()
+	return content_box(to_array(render(from_blob(blob), edits)), fuzz)
+
+#Crops that trim every card of the deck, as (card, edit) pairs. The deck
+#is only read here; rendering and measuring happen in the pool, of one
+#process per core unless processes says otherwise (1 for no pool).
+def trim_edits(deck, fuzz, call=None, indices=None, processes=None):
+	indices = list(range(len(deck)) if indices is None else indices)
+	processes = min(processes or cpu_count(), len(indices))
+	pool = Pool(processes) if processes > 1 else None
+	run = pool.imap if pool is not None else map
+	window = WINDOW*max(processes, 1)
+	pairs = []
+	try:
+		for start in range(0, len(indices), window):
+			chunk = indices[start:start+window]
+			tasks = [deck.snapshot(num) + (fuzz, ) for num in chunk]
+			for num, box in zip(chunk, run(_box, tasks)):
+				if box:
+					pairs.append((num, edit("crop", **box)))
+				if call is not None:
+					call()
+		if pool is not None:
+			pool.close()
+	except:
+		if pool is not None:
+			pool.terminate()
+		raise
+	finally:
+		if pool is not None:
+			pool.join()
+	return pairs
+
+def border_edits(deck, call=None, indices=None, processes=None):
+	return trim_edits(deck, UNIFORM, call, indices, processes)
+
+#Runs of True in a 1-d bool array, as (start, end) with end excluded
+def runs(flags):
+	padded = numpy.concatenate(([0], flags.astype(numpy.int8), [0]))
+	edges = numpy.flatnonzero(numpy.diff(padded))
+	return [(int(start), int(end)) for start, end in zip(edges[::2], edges[1::2])]
+
+#(cells, sep, before, after) along one axis, from which of its lines are empty.
+#The most cells whose gutters all show up where equal cells put them win.
+def axis_grid(empty, limit=MAX_CELLS):
+	content = numpy.flatnonzero(~empty)
+	if not len(content):
+		return None
+	first, last = int(content[0]), int(content[-1]) + 1
+	length = last - first
+	gaps = runs(empty[first:last])
+	for cells in range(min(limit, len(gaps) + 1), 1, -1):
+		pitch = length/float(cells)
+		found = []
+		for num in range(1, cells):
+			centre = pitch*num
+			near = [gap for gap in gaps if gap[0] - pitch*0.02 <= centre <= gap[1] + pitch*0.02]
+			if not near:
+				break
+			found.append(near[0])
+		if len(found) < cells - 1 or len(set(found)) < len(found):
+			continue
+		widths = [end - start for start, end in found]
+		if max(widths) - min(widths) > max(2, min(widths)//2):
+			continue
+		return cells, int(numpy.median(widths)), first, len(empty) - last
+	return 1, 0, first, len(empty) - last
+
+#{"n", "m", "row_sep", "col_sep", "crop"} of the card grid on a sheet,
+#crop taking off its outer margins, or None if it holds a single card
+def grid(arr, fuzz=GRID_FUZZ):
+	arr = numpy.asarray(arr, dtype=numpy.int16)
+	mask = numpy.abs(arr - arr[:1, :1, :]).max(axis=2) > fuzz*255/100.0
+	rows = axis_grid(mask.mean(axis=1) <= GUTTER)
+	cols = axis_grid(mask.mean(axis=0) <= GUTTER)
+	if rows is None or cols is None or rows[0]*cols[0] == 1:
+		return None
+	crop = {"top": rows[2], "bottom": rows[3], "left": cols[2], "right": cols[3]}
+	return {"n": rows[0], "m": cols[0], "row_sep": rows[1], "col_sep": cols[1],
+			"crop": dict((side, px) for side, px in crop.items() if px)}
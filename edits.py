@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Non-destructive card edits. An edit is an (op, args, kwargs) triple named
+after the Deck method that performs it; a card keeps a list of them and
+the pixels are only touched when the card is rendered for preview or
+export, after fusing the list.
+"""
+
+from imaging import cards
+
+#Edits that can be deferred, the rest change the number of cards
+DEFERRED = ("crop", "trim", "del_borders", "borders")
+SIDES = ("top", "right", "bottom", "left")
+COLORS = ("black", "white")
+
+#Colours are kept by name so edit lists can be pickled and saved
+def color_name(color):
+	from pnp import Border
+	for name in COLORS:
+		if color == name or color == getattr(Border, name):
+			return name
+	raise ValueError("Unknown border colour %r" % (color,))
+
+def resolve(op, args):
+	if op == "borders":
+		from pnp import Border
+		return (getattr(Border, color_name(args[0])),) + tuple(args[1:])
+	return tuple(args)
+
+def apply(deck, op, args=(), kwargs=None, call=None):
+	kwargs = dict(kwargs or {})
+	if call is not None:
+		kwargs["call"] = call
+	return getattr(deck, op)(*resolve(op, args), **kwargs)
+
+def edit(op, *args, **kwargs):
+	if op == "borders":
+		args = (color_name(args[0]),) + args[1:]
+	return (op, tuple(args), dict(kwargs))
+
+#Consecutive crops add up. Trims and border removals stay as they are: a
+#second one looks at the new corner colour and can take the next frame.
+def fuse(edits):
+	fused = []
+	for op, args, kwargs in edits:
+		if fused and op == "crop" and fused[-1][0] == "crop":
+			last = fused[-1][2]
+			kwargs = dict((side, last.get(side, 0) + kwargs.get(side, 0)) for side in SIDES
+					if last.get(side, 0) + kwargs.get(side, 0))
+			fused[-1] = (op, args, kwargs)
+		else:
+			fused.append((op, args, kwargs))
+	return fused
+
+def render(card, edits):
+	if not edits:
+		return card
+	from pnp import Deck
+	deck = Deck([card])
+	for op, args, kwargs in fuse(edits):
+		apply(deck, op, args, kwargs)
+	return cards(deck)[0]
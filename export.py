@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Streaming PDF export. Sheets are laid out and painted one at a time
+straight into the output file, so only the cards of the current sheet are
+ever decoded and pages reach the disk as they are done. Where the cards
+go on every sheet comes from packing, rotated cards included. With a sheets
+folder every encoded card is also kept there, named after what it looks
+like and how it was encoded, and the next export paints the cards that
+didn't change from it instead of encoding them again. The pdf is the same
+either way. The pdf is written beside its final name, as name.partial.pdf,
+and only renamed over it once every page is done, so a cancelled or failed
+export leaves the last good one in place.
+
+Identical cards are painted from the same QImage.
+Qt's pdf engine embeds an image once and references it from then on, so
+a deck of repeated cards or a back on every other page is written, and
+stored, once per distinct image, as long as the image is still around
+for its next copy: the latest ones are, and so are the ones already
+painted twice, up to PINNED_BYTES.
+
+Before a sheet is painted its cards go through an encode stage, spread
+over a process pool: rendered, shrunk to the print dpi of the size they
+print at and reduced to grey or to two levels for line art. Qt picks the
+pdf encoding itself, JPEG for colour and Flate for grey, so the colour
+mode is also the choice between the two.
+"""
+
+import hashlib
+import json
+import os
+import zlib
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+from imaging import bmp_qimage, encode, from_blob, size, to_blob
+from edits import render
+import packing
+from packing import PAPER_SIZES, CARD_SIZES, MM, card_size_mm, paper_size_mm
+
+#Cards without a card size are printed at their own pixel size
+DPI = 300
+
+COLORS = ("color", "gray", "lineart")
+#Repeated cards kept for the whole export
+PINNED_BYTES = 512*1024**2
+
+#Accepts both 'Poker' and the full combo text
+def card_size_text(name):
+	for text in CARD_SIZES:
+		if text.lower().startswith(name.lower().split(" (")[0] + " ("):
+			return text
+	raise ValueError("Unknown card size %r" % name)
+
+#Millimetres of a card printed at its own pixel size. A CardStore knows
+#it without rendering the card unless it has a pending trim.
+def card_mm(deck, num):
+	px = deck.rendered_size(deck.meta[num]) if hasattr(deck, "rendered_size") else None
+	if px is None:
+		px = size(deck[num])
+	return px[0]*MM/DPI, px[1]*MM/DPI
+
+#"print/deck.pdf" -> "print/deck.partial.pdf"
+def partial_path(path):
+	root, ext = os.path.splitext(path)
+	return root + ".partial" + ext
+
+#Runs in the workers, returns BMP for Qt
+def _encode(task):
+	blob, edits, px, rotated, colors = task
+	return encode(render(from_blob(blob), edits), px, rotated, colors)
+
+#Images by the hash of their pixels, the most recently painted ones kept,
+#and the ones painted more than once kept for good while pinned_bytes
+#lasts. Past that, a repeated card that left the LRU is embedded again.
+#Cards are known by their source and how they were encoded, so a card
+#seen already isn't encoded again.
+class ImageCache(object):
+
+	def __init__(self, size=32, pinned_bytes=PINNED_BYTES):
+		self.size = size
+		self.items = OrderedDict()
+		self.digests = {}
+		self.seen = set()
+		self.pinned = {}
+		self.pinned_bytes = pinned_bytes
+
+	def get(self, key):
+		img = self.pinned.get(key)
+		if img is not None:
+			return img
+		img = self.items.pop(key, None)
+		if img is not None:
+			self.items[key] = img
+		return img
+
+	def pin(self, digest, img):
+		if digest not in self.pinned and img.byteCount() <= self.pinned_bytes:
+			self.pinned[digest] = img
+			self.pinned_bytes -= img.byteCount()
+		return img
+
+	def put(self, key, img):
+		self.items[key] = img
+		while len(self.items) > self.size:
+			self.items.popitem(last=False)
+		return img
+
+	#Every hit is a repeat
+	def image(self, key):
+		digest = self.digests.get(key)
+		img = None if digest is None else self.get(digest)
+		return None if img is None else self.pin(digest, img)
+
+	def add(self, key, blob):
+		digest = hashlib.sha1(blob).hexdigest()
+		self.digests[key] = digest
+		img = self.get(digest)
+		if img is None:
+			img = self.put(digest, bmp_qimage(blob))
+		if digest in self.seen:
+			return self.pin(digest, img)
+		self.seen.add(digest)
+		return img
+
+class StreamPrinter(object):
+
+	def __init__(self):
+		self.deck = None
+		self.card_size = None
+		self.paper_size = "A4"
+		self.orientation = "Portrait"
+		self.print_path = None
+		self.sheets = None
+		#Cards are shrunk to this many pixels per inch of paper, None keeps them
+		self.dpi = DPI
+		self.colors = "color"
+		self.parallel = False
+		self.images = None
+		#Names of the kept cards this export used, None when none are kept
+		self.used = None
+
+	def config(self, deck=None, card_size=None, paper_size=None, orientation=None, print_path=None, sheets=None,
+			dpi=None, colors=None, parallel=None):
+		if deck is not None:
+			self.deck = deck
+		if card_size is not None:
+			self.card_size = card_size
+		if paper_size is not None:
+			self.paper_size = paper_size
+		if orientation is not None:
+			self.orientation = orientation
+		if print_path is not None:
+			self.print_path = print_path
+		if sheets is not None:
+			self.sheets = sheets
+		if dpi is not None:
+			self.dpi = dpi or None
+		if colors is not None:
+			if colors not in COLORS:
+				raise ValueError("Unknown colour mode %r" % colors)
+			self.colors = colors
+		if parallel is not None:
+			self.parallel = parallel
+
+	def paper(self):
+		return paper_size_mm(self.paper_size, self.orientation)
+
+	#[[(num, x, y, w, h, rotated)]] for every sheet, in millimetres
+	def layout(self, card_size):
+		if card_size is not None:
+			return packing.uniform(len(self.deck), packing.layout(card_size, self.paper_size, self.orientation))
+		return packing.pack(self.paper(), [card_mm(self.deck, num) for num in range(len(self.deck))])
+
+	#The layout is worked out here, on the job's thread, as it may render
+	#cards to know their size. call gets the sheets after every page, so
+	#the progress goes by pages without counting them beforehand.
+	def print_sheets(self, card_size=None, call=None):
+		if len(self.deck) == 0:
+			return
+		from PyQt4.QtGui import QPainter, QPrinter
+		paper = self.paper()
+		sheets = self.layout(card_size)
+		partial = partial_path(self.print_path)
+		printer = QPrinter(QPrinter.HighResolution)
+		printer.setOutputFormat(QPrinter.PdfFormat)
+		printer.setOutputFileName(partial)
+		printer.setPaperSize(getattr(QPrinter, self.paper_size))
+		printer.setOrientation(QPrinter.Landscape if self.orientation == "Landscape" else QPrinter.Portrait)
+		printer.setColorMode(QPrinter.Color if self.colors == "color" else QPrinter.GrayScale)
+		printer.setFullPage(True)
+		px = printer.resolution()/MM
+		reuse = self.sheets is not None and hasattr(self.deck, "fingerprint")
+		if reuse and not os.path.isdir(self.sheets):
+			os.makedirs(self.sheets)
+		self.used = set() if reuse else None
+		self.images = ImageCache()
+		pool = Pool(cpu_count()) if self.parallel and cpu_count() > 1 else None
+		painter = QPainter(printer)
+		done = False
+		try:
+			for page, placements in enumerate(sheets):
+				if page > 0:
+					printer.newPage()
+				self.paint_sheet(painter, px, placements, pool)
+				if call is not None:
+					call(sheets)
+			if pool is not None:
+				pool.close()
+			done = True
+		except:
+			if pool is not None:
+				pool.terminate()
+			raise
+		finally:
+			painter.end()
+			if pool is not None:
+				pool.join()
+			self.images = None
+			if not done and os.path.exists(partial):
+				os.remove(partial)
+		os.rename(partial, self.print_path)
+		if reuse:
+			for name in os.listdir(self.sheets):
+				if name not in self.used:
+					os.remove(os.path.join(self.sheets, name))
+			self.used = None
+
+	#Pixels the card is shrunk to, from its size on paper
+	def target_px(self, w, h):
+		if self.dpi is None:
+			return None
+		return max(1, int(round(w*self.dpi/MM))), max(1, int(round(h*self.dpi/MM)))
+
+	#(key, (blob, edits) or None). A CardStore card is known by its
+	#fingerprint and only read if it has to be encoded.
+	def source(self, num):
+		if hasattr(self.deck, "fingerprint"):
+			return self.deck.fingerprint(num), None
+		blob = to_blob(self.deck[num])
+		return hashlib.sha1(blob).hexdigest(), (blob, [])
+
+	#QImages of the cards of a sheet, those not seen yet encoded in the pool
+	def encode(self, placements, pool=None):
+		keys, found, tasks = [], {}, OrderedDict()
+		for num, x, y, w, h, rotated in placements:
+			source, data = self.source(num)
+			key = (source, self.target_px(w, h), rotated, self.colors)
+			keys.append(key)
+			if key in found or key in tasks:
+				continue
+			img = self.images.image(key)
+			if img is not None:
+				found[key] = img
+				continue
+			blob = self.kept(key)
+			if blob is not None:
+				found[key] = self.images.add(key, blob)
+				continue
+			blob, edits = data if data is not None else self.deck.snapshot(num)
+			tasks[key] = (blob, edits) + key[1:]
+		run = pool.map if pool is not None and len(tasks) > 1 else map
+		for key, blob in zip(list(tasks), run(_encode, list(tasks.values()))):
+			self.keep(key, blob)
+			found[key] = self.images.add(key, blob)
+		return [found[key] for key in keys]
+
+	def paint_sheet(self, painter, px, placements, pool=None):
+		from PyQt4.QtCore import QRectF
+		for place, img in zip(placements, self.encode(placements, pool)):
+			num, x, y, w, h, rotated = place
+			painter.drawImage(QRectF(x*px, y*px, w*px, h*px), img)
+
+	#Encoded cards in the sheets folder are named after their key: the
+	#card's fingerprint, pixels, rotation and colours
+	def kept_name(self, key):
+		return hashlib.sha1(json.dumps(list(key)).encode("utf-8")).hexdigest() + ".card"
+
+	#The encoded card kept by an earlier export, or None
+	def kept(self, key):
+		if self.used is None:
+			return None
+		name = self.kept_name(key)
+		self.used.add(name)
+		try:
+			with open(os.path.join(self.sheets, name), "rb") as f:
+				return zlib.decompress(f.read())
+		except (IOError, OSError, zlib.error):
+			return None
+
+	def keep(self, key, blob):
+		if self.used is None:
+			return
+		path = os.path.join(self.sheets, self.kept_name(key))
+		with open(path + ".new", "wb") as f:
+			f.write(zlib.compress(blob, 1))
+		os.rename(path + ".new", path)
+
+	def print_pdf(self, call=None):
+		self.print_sheets(self.card_size, call)
+
+	def print_grid(self, call=None):
+		self.print_sheets(None, call)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Bridge between pnp cards and raw image data. pnp keeps the pixels of a
+Card as a wand Image in card.img; nothing else in this program should rely
+on that. pnp and wand are only imported once a card is made, they take a
+while to load.
+"""
+
+import os
+
+#ImageMagick's own format: uncompressed, lossless and quick to decode
+FORMAT = "miff"
+
+def to_blob(card, format=FORMAT):
+	return card.img.make_blob(format)
+
+def from_blob(blob):
+	from pnp import Card
+	from wand.image import Image
+	return Card(Image(blob=blob))
+
+_pages = {}
+
+#Opens the whole pdf, so counts are remembered for as long as the file
+#keeps its size and mtime
+def page_count(file):
+	if not file.lower().endswith(".pdf"):
+		return 1
+	stat = os.stat(file)
+	known = (file, stat.st_size, stat.st_mtime)
+	if known not in _pages:
+		from wand.image import Image
+		with Image(filename=file, resolution=1) as doc:
+			_pages[known] = len(doc.sequence)
+	return _pages[known]
+
+#(width, height) in pixels
+def size(card):
+	return tuple(card.img.size)
+
+def clone(card):
+	from pnp import Card
+	return Card(card.img.clone())
+
+def cards(deck):
+	return [deck[i] for i in range(len(deck))]
+
+#BMP is the cheapest format both ImageMagick and Qt understand
+def to_qimage(card):
+	return bmp_qimage(to_blob(card, "bmp"))
+
+def bmp_qimage(blob):
+	from PyQt4.QtGui import QImage
+	img = QImage()
+	img.loadFromData(blob, "BMP")
+	return img
+
+#BMP for painting, shrunk to px when bigger, turned a quarter clockwise
+#and reduced to grey or to black and white
+def encode(card, px=None, rotated=False, colors="color"):
+	with card.img.clone() as img:
+		if rotated:
+			img.rotate(90)
+		if px is not None and (img.width > px[0] or img.height > px[1]):
+			img.resize(min(img.width, px[0]), min(img.height, px[1]))
+		if colors != "color":
+			img.type = "grayscale"
+		if colors == "lineart":
+			img.threshold(0.5)
+		return img.make_blob("bmp")
+
+#File contents in format ("png", "jpg"), quality 1-100 for jpg
+def to_file(card, format, quality=None):
+	with card.img.clone() as img:
+		img.format = format
+		if quality is not None:
+			img.compression_quality = quality
+		return img.make_blob(format)
+
+#8 bit pixels as a (height, width, 3) numpy array
+def to_array(card):
+	import numpy
+	with card.img.clone() as img:
+		img.depth = 8
+		img.alpha_channel = False
+		data = img.make_blob("RGB")
+		return numpy.frombuffer(data, dtype=numpy.uint8).reshape(img.height, img.width, 3)
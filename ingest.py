@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+PDF ingestion. Pages are rasterized in parallel, one process per core,
+only for the requested page range and at no more resolution than the card
+size will print, and are handed over in order as soon as they are ready.
+"""
+
+from multiprocessing import Pool, cpu_count
+
+from imaging import FORMAT, page_count
+from export import card_size_mm, MM
+import cache
+
+#Resolution cards are printed at
+PRINT_DPI = 300
+MIN_DPI = 72
+MAX_DPI = 600
+
+def is_pdf(file):
+	return file.lower().endswith(".pdf")
+
+#"1-3,7" -> [0, 1, 2, 6], None means every page. Pages are numbered from
+#1 to count, a range outside them is an error.
+def parse_pages(text, count):
+	if not text:
+		return list(range(count))
+	pages = []
+	for part in str(text).split(","):
+		first, _, last = part.strip().partition("-")
+		first = int(first) if first else 1
+		last = int(last) if last else (count if _ else first)
+		if not 1 <= first <= last <= count:
+			raise ValueError("Page range %s is outside 1-%d" % (part.strip(), count))
+		pages.extend(page - 1 for page in range(first, last + 1))
+	return pages
+
+#Page ranges only mean something for pdfs, images are always loaded
+def file_pages(file, pages):
+	return pages if is_pdf(file) else None
+
+#Inches of the first page
+def page_size(file):
+	from wand.image import Image
+	with Image(filename=file + "[0]", resolution=MIN_DPI) as page:
+		return page.width/float(MIN_DPI), page.height/float(MIN_DPI)
+
+#Enough dpi for every one of the n x m cards of a page to print at
+#PRINT_DPI on a card of card_size
+def target_dpi(file, card_size, n=1, m=1):
+	if not is_pdf(file):
+		return None
+	width, height = page_size(file)
+	card_w, card_h = [side/MM for side in card_size_mm(card_size)]
+	dpi = PRINT_DPI*max(card_w*m/width, card_h*n/height)
+	return int(min(MAX_DPI, max(MIN_DPI, dpi + 0.5)))
+
+def _rasterize(task):
+	from wand.image import Image
+	file, page, dpi = task
+	if not is_pdf(file):
+		img = Image(filename=file)
+	else:
+		img = Image(filename="%s[%d]" % (file, page), resolution=dpi)
+	with img:
+		return img.make_blob(FORMAT), tuple(img.size)
+
+#(blob, size) of every page, in order
+def rasterize(file, pages=None, dpi=PRINT_DPI, processes=None):
+	tasks = [(file, page, dpi) for page in parse_pages(pages, page_count(file))]
+	processes = min(processes or cpu_count(), len(tasks))
+	if processes <= 1:
+		for task in tasks:
+			yield _rasterize(task)
+		return
+	pool = Pool(processes)
+	try:
+		for page in pool.imap(_rasterize, tasks):
+			yield page
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+def count(file, pages=None):
+	return len(parse_pages(file_pages(file, pages), page_count(file)))
+
+#add(blob, source, size) defaults to deck.add_blob, call runs once per page.
+#Pages already rasterized in an earlier run come from the disk cache.
+def ingest(deck, file, pages=None, dpi=PRINT_DPI, call=None, add=None, processes=None):
+	add = deck.add_blob if add is None else add
+	dpi = dpi or PRINT_DPI
+	pages = file_pages(file, pages)
+	disk = cache.shared()
+	key = None if disk is None else disk.source_key([file], "raster", pages, dpi)
+	found = None if disk is None else disk.get(key)
+	if found is not None:
+		source, writer = disk.cards(found), None
+	else:
+		source = rasterize(file, pages, dpi, processes)
+		writer = None if disk is None else disk.writer(key)
+	try:
+		for blob, size in source:
+			add(blob, file, size)
+			if writer is not None:
+				writer.add(blob, size)
+			if call is not None:
+				call()
+	except:
+		if writer is not None:
+			writer.abort()
+		raise
+	if writer is not None:
+		writer.commit()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Background jobs for the deck operations, so the event loop keeps painting
+while Deck and Printer do the heavy work on a QThread.
+"""
+
+from PyQt4.QtCore import QObject, QThread, pyqtSignal
+
+class JobCancelled(Exception):
+	pass
+
+class Job(QThread):
+	progress = pyqtSignal(int)
+
+	def __init__(self, name, func, total=1, parent=None):
+		QThread.__init__(self, parent)
+		self.name = name
+		self.func = func
+		self.total = max(total, 1)
+		self.count = 0
+		self.cancelled = False
+		self.error = None
+
+	def cancel(self):
+		self.cancelled = True
+
+	#Same signature as MainWindow.next_percent, so it can be given as call=
+	def step(self, l=None):
+		if self.cancelled:
+			raise JobCancelled(self.name)
+		total = self.total if l is None else max(len(l), 1)
+		self.count += 1
+		self.progress.emit(min(99, self.count*100//total))
+
+	def run(self):
+		try:
+			self.func(self.step)
+		except JobCancelled:
+			pass
+		except Exception as e:
+			self.error = "%s failed: %s" % (self.name, e)
+
+class JobRunner(QObject):
+	started = pyqtSignal(str)
+	progress = pyqtSignal(int)
+	finished = pyqtSignal(str, str)
+	queued = pyqtSignal(object)
+
+	def __init__(self, parent=None):
+		QObject.__init__(self, parent)
+		self.job = None
+		self.after = None
+		self.queued.connect(self.call_queued)
+
+	def busy(self):
+		return self.job is not None
+
+	#func receives the step callback; after runs on the GUI thread once done
+	def start(self, name, func, total=1, after=None):
+		if self.busy():
+			return False
+		self.job = Job(name, func, total, self)
+		self.after = after
+		self.job.progress.connect(self.progress)
+		self.job.finished.connect(self.job_finished)
+		self.started.emit(name)
+		self.job.start()
+		return True
+
+	#From the job, runs func on the GUI thread, in order and before after
+	def later(self, func):
+		self.queued.emit(func)
+
+	def call_queued(self, func):
+		func()
+
+	def cancel(self):
+		if self.busy():
+			self.job.cancel()
+
+	def wait(self):
+		if self.busy():
+			self.job.wait()
+
+	def job_finished(self):
+		job, after = self.job, self.after
+		self.job, self.after = None, None
+		if job.error is not None:
+			status = job.error
+		elif job.cancelled:
+			status = "%s cancelled" % job.name
+		else:
+			status = ""
+			if after is not None:
+				after()
+		self.finished.emit(job.name, status)
+		job.deleteLater()
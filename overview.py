@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Whole deck overview. The cards are tiles of a list view, which only asks
+for the tiles it paints, so a deck of thousands scrolls as fast as one of
+ten. Tiles come from a small pyramid of thumbnail sizes: a card rendered
+once gives every smaller size too, and zooming out only scales what is
+already there. Missing tiles are read and rendered on background threads,
+the most recently asked first, and show up as they are done; painting
+only queues which file and edits they come from.
+"""
+
+from collections import deque
+from threading import Condition, Thread
+
+from PyQt4.QtCore import QAbstractListModel, QModelIndex, QObject, QSize, Qt, pyqtSignal
+from PyQt4.QtGui import QColor, QImage, QListView, QShortcut, QKeySequence
+
+from thumbs import ThumbnailCache, held_thumbnail
+
+#Tile sizes, the long side in pixels
+LEVELS = (64, 128, 256)
+SPACING = 6
+
+def box(level):
+	return int(level*0.72), level
+
+#Renders tiles on worker threads; requests past max_pending, the oldest,
+#are forgotten, they will be asked again if they are still on screen.
+#Every request holds its card's file until it is read or forgotten.
+class TileLoader(QObject):
+
+	loaded = pyqtSignal(object)
+
+	def __init__(self, thumbs, workers=2, max_pending=256):
+		QObject.__init__(self)
+		self.thumbs = thumbs
+		self.max_pending = max_pending
+		self.pending = deque()
+		self.queued = set()
+		self.ready = Condition()
+		for num in range(workers):
+			worker = Thread(target=self.work)
+			worker.daemon = True
+			worker.start()
+
+	def request(self, key, store, num, level):
+		with self.ready:
+			if (key, level) in self.queued:
+				return
+			file, edits = store.hold(num)
+			self.pending.appendleft((key, store, file, edits, level))
+			self.queued.add((key, level))
+			while len(self.pending) > self.max_pending:
+				old = self.pending.pop()
+				self.queued.discard((old[0], old[4]))
+				old[1].release(old[2])
+			self.ready.notify()
+
+	def clear(self):
+		with self.ready:
+			for key, store, file, edits, level in self.pending:
+				store.release(file)
+			self.pending.clear()
+			self.queued.clear()
+
+	def work(self):
+		while True:
+			with self.ready:
+				while not self.pending:
+					self.ready.wait()
+				key, store, file, edits, level = self.pending.popleft()
+			try:
+				img = held_thumbnail(store, file, edits, *box(level))
+				#Every smaller level comes from this one
+				for smaller in LEVELS:
+					if smaller < level:
+						w, h = box(smaller)
+						self.thumbs.put((key, smaller), img.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+				self.thumbs.put((key, level), img)
+			except Exception:
+				pass
+			with self.ready:
+				self.queued.discard((key, level))
+			self.loaded.emit(key)
+
+class OverviewModel(QAbstractListModel):
+
+	def __init__(self, store, busy, parent=None):
+		QAbstractListModel.__init__(self, parent)
+		self.store = store
+		self.busy = busy
+		self.level = LEVELS[1]
+		self.thumbs = ThumbnailCache(size=1024, ahead=0)
+		self.loader = TileLoader(self.thumbs)
+		self.loader.loaded.connect(self.tile_loaded)
+		self.rows = {}
+		#The store's changes at the last refresh
+		self.seen = None
+		w, h = box(self.level)
+		self.blank = self.placeholder(w, h)
+
+	def placeholder(self, width, height):
+		img = QImage(width, height, QImage.Format_RGB32)
+		img.fill(QColor(220, 220, 220).rgb())
+		return img
+
+	def set_store(self, store):
+		self.store = store
+		self.loader.clear()
+		self.refresh()
+
+	#Tiles are known by what the card looks like, so after a change only
+	#the cards that changed are rendered again
+	def refresh(self):
+		self.seen = self.store.changes
+		self.rows.clear()
+		self.reset()
+
+	#A refresh only if the deck changed since the last one
+	def sync(self):
+		if self.seen != self.store.changes:
+			self.refresh()
+
+	def rowCount(self, parent=QModelIndex()):
+		return 0 if parent.isValid() else len(self.store)
+
+	def data(self, index, role=Qt.DisplayRole):
+		if not index.isValid() or index.row() >= len(self.store):
+			return None
+		num = index.row()
+		if role == Qt.DisplayRole:
+			return str(num + 1)
+		if role == Qt.DecorationRole:
+			return self.tile(num)
+		return None
+
+	#The tile if there is one; a bigger one scaled down; else a blank one
+	#while it is rendered
+	def tile(self, num):
+		key = self.store.key(num)
+		img = self.thumbs.get((key, self.level))
+		if img is not None:
+			return img
+		w, h = box(self.level)
+		for bigger in LEVELS:
+			if bigger > self.level:
+				img = self.thumbs.get((key, bigger))
+				if img is not None:
+					img = img.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+					self.thumbs.put((key, self.level), img)
+					return img
+		#A job may be changing the deck; its end refreshes everything
+		if not self.busy():
+			self.rows.setdefault(key, set()).add(num)
+			self.loader.request(key, self.store, num, self.level)
+		return self.blank
+
+	def tile_loaded(self, key):
+		for num in self.rows.pop(key, ()):
+			if num < len(self.store):
+				index = self.index(num)
+				self.dataChanged.emit(index, index)
+
+	def zoom(self, step):
+		pos = LEVELS.index(self.level) + step
+		if 0 <= pos < len(LEVELS):
+			self.level = LEVELS[pos]
+			self.blank = self.placeholder(*box(self.level))
+			self.loader.clear()
+			self.refresh()
+			return True
+		return False
+
+class OverviewView(QListView):
+
+	#Emitted with the card number on double click
+	chosen = pyqtSignal(int)
+
+	def __init__(self, store, busy, parent=None):
+		QListView.__init__(self, parent)
+		self.setWindowTitle("Overview")
+		self.setViewMode(QListView.IconMode)
+		self.setResizeMode(QListView.Adjust)
+		self.setMovement(QListView.Static)
+		self.setUniformItemSizes(True)
+		self.setLayoutMode(QListView.Batched)
+		self.setBatchSize(200)
+		self.setSpacing(SPACING)
+		self.overview = OverviewModel(store, busy, self)
+		self.setModel(self.overview)
+		self.apply_level()
+		self.doubleClicked.connect(lambda index: self.chosen.emit(index.row()))
+		QShortcut(QKeySequence.ZoomIn, self, lambda: self.zoom(1))
+		QShortcut(QKeySequence.ZoomOut, self, lambda: self.zoom(-1))
+		self.resize(900, 700)
+
+	def apply_level(self):
+		self.setIconSize(QSize(*box(self.overview.level)))
+
+	def zoom(self, step):
+		if self.overview.zoom(step):
+			self.apply_level()
+
+	def wheelEvent(self, e):
+		if e.modifiers() & Qt.ControlModifier:
+			self.zoom(1 if e.delta() > 0 else -1)
+		else:
+			QListView.wheelEvent(self, e)
+
+	def refresh(self, store=None):
+		if store is not None:
+			self.overview.set_store(store)
+		else:
+			self.overview.refresh()
+
+	def sync(self):
+		self.overview.sync()
+
+	#Tiles already asked for aren't rendered while a job changes the deck
+	def pause(self):
+		self.overview.loader.clear()
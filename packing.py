@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Sheet packing. A sheet of same sized cards is a block of upright cards
+next to (or above) a block of rotated ones, whichever split fits the most;
+plain upright and plain rotated grids are the splits with an empty block.
+The layout of every card size and paper size of the combo boxes is
+computed once, the first time one is asked for, and then only looked up. Decks of mixed
+sizes are packed in shelves, rotating the cards that fit better sideways.
+
+Placements are (x, y, w, h, rotated) in millimetres, w and h being the
+size of the card on the sheet (already swapped when rotated). Cards are
+kept MARGIN away from the edges, which most printers can't reach.
+"""
+
+import re
+
+#Millimetres, portrait
+PAPER_SIZES = {"A0": (841, 1189), "A1": (594, 841), "A2": (420, 594), "A3": (297, 420),
+		"A4": (210, 297), "A5": (148, 210), "A6": (105, 148)}
+
+#As listed in card_size_combo
+CARD_SIZES = ['Jumbo (3.5" w : 5.5" l)', 'Tarot (2.75" w : 4.75" l)', 'Square (3.5" w : 3.5" l)',
+		'Poker (2.5" w : 3.5" l)', 'Bridge (2.25" w : 3.5" l)', 'Biz (2" w : 3.5" l)',
+		'Mini (1.75" w : 2.5" l)', 'Micro (1.25" w : 1.75" l)']
+
+ORIENTATIONS = ["Portrait", "Landscape"]
+
+MM = 25.4
+#Millimetres left blank around every sheet
+MARGIN = 5
+
+#'Poker (2.5" w : 3.5" l)' -> (63.5, 88.9)
+def card_size_mm(text):
+	w, l = re.search(r'([\d.]+)" w : ([\d.]+)" l', text).groups()
+	return float(w)*MM, float(l)*MM
+
+def paper_size_mm(paper_size, orientation="Portrait"):
+	w, h = PAPER_SIZES[paper_size]
+	return (h, w) if orientation == "Landscape" else (w, h)
+
+def block(x, y, width, height, card, rotated):
+	w, h = (card[1], card[0]) if rotated else card
+	if w > width or h > height:
+		return []
+	cols, rows = int(width // w), int(height // h)
+	return [(x + col*w, y + row*h, w, h, rotated) for row in range(rows) for col in range(cols)]
+
+#Moves the placements so their bounding box is centred on the sheet
+def centre(paper, placements):
+	if not placements:
+		return placements
+	right = max(place[0] + place[2] for place in placements)
+	bottom = max(place[1] + place[3] for place in placements)
+	dx, dy = (paper[0] - right)/2, (paper[1] - bottom)/2
+	return [(place[0] + dx, place[1] + dy) + tuple(place[2:]) for place in placements]
+
+#Size of the part of the sheet cards go on
+def printable(paper):
+	return paper[0] - 2*MARGIN, paper[1] - 2*MARGIN
+
+def best_layout(paper, card):
+	width, height = printable(paper)
+	candidates = [block(0, 0, width, height, card, False), block(0, 0, width, height, card, True)]
+	for first in (False, True):
+		w, h = (card[1], card[0]) if first else card
+		#Columns of one orientation on the left, the other on the right
+		for cols in range(1, int(width // w)):
+			split = cols*w
+			candidates.append(block(0, 0, split, height, card, first) +
+					block(split, 0, width - split, height, card, not first))
+		#Rows of one orientation on top, the other below
+		for rows in range(1, int(height // h)):
+			split = rows*h
+			candidates.append(block(0, 0, width, split, card, first) +
+					block(0, split, width, height - split, card, not first))
+	#Ties go to the earliest candidate, the plain upright grid first
+	best = max(candidates, key=len)
+	if not best:
+		#Bigger than the sheet: one card, shrunk to fit
+		scale = min(width/card[0], height/card[1])
+		best = [(0, 0, card[0]*scale, card[1]*scale, False)]
+	return centre(paper, best)
+
+LAYOUTS = {}
+
+def layouts():
+	for card_size in CARD_SIZES:
+		for paper_size in PAPER_SIZES:
+			for orientation in ORIENTATIONS:
+				LAYOUTS[(card_size, paper_size, orientation)] = best_layout(
+						paper_size_mm(paper_size, orientation), card_size_mm(card_size))
+
+def layout(card_size, paper_size, orientation="Portrait"):
+	if not LAYOUTS:
+		layouts()
+	key = (card_size, paper_size, orientation)
+	if key not in LAYOUTS:
+		LAYOUTS[key] = best_layout(paper_size_mm(paper_size, orientation), card_size_mm(card_size))
+	return LAYOUTS[key]
+
+#Same sized cards fill every sheet with the same layout
+def uniform(count, placements):
+	per_sheet = len(placements)
+	return [[(first + slot, ) + placements[slot] for slot in range(min(per_sheet, count - first))]
+			for first in range(0, count, per_sheet)]
+
+#Both ways a card can go on the sheet, upright first. Cards bigger than
+#the sheet are shrunk to fit it.
+def orientations(paper, card):
+	scale = min(1.0, paper[0]/card[0], paper[1]/card[1])
+	w, h = card[0]*scale, card[1]*scale
+	if h > paper[0] or w > paper[1]:
+		return [(w, h, False)]
+	return [(w, h, False), (h, w, True)]
+
+#Shelves across the sheet, top to bottom, cards in deck order. Every card
+#takes the way that wastes the least of its shelf's height.
+def shelves(paper, sizes):
+	width, height = printable(paper)
+	sheets, sheet = [], []
+	x, y, shelf = 0.0, 0.0, 0.0
+	for num, card in enumerate(sizes):
+		options = orientations((width, height), card)
+		fits = [el for el in options if x + el[0] <= width and y + el[1] <= height]
+		if x > 0 and fits:
+			w, h, rotated = min(fits, key=lambda el: abs(shelf - el[1]))
+		else:
+			if x > 0 or not fits:
+				x, y, shelf = 0.0, y + shelf, 0.0
+				fits = [el for el in options if y + el[1] <= height]
+				if not fits:
+					if sheet:
+						sheets.append(centre(paper, sheet))
+					sheet, y, fits = [], 0.0, options
+			w, h, rotated = fits[0]
+		sheet.append((x, y, w, h, rotated, num))
+		x += w
+		shelf = max(shelf, h)
+	if sheet:
+		sheets.append(centre(paper, sheet))
+	return [[(place[5], ) + place[:5] for place in placed] for placed in sheets]
+
+#[[(num, x, y, w, h, rotated)]] for every sheet, sizes in millimetres
+def pack(paper, sizes):
+	if not sizes:
+		return []
+	if all(size == sizes[0] for size in sizes):
+		return uniform(len(sizes), best_layout(paper, sizes[0]))
+	return shelves(paper, sizes)
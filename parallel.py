@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Whole-deck transforms. A CardStore records crops, trims and borders as
+edits and splits as views, so none of them touches pixels when it runs.
+The per-card work that does need the pixels goes through process pools
+of its own: trims and border removals are measured in detect's, cards are
+encoded for the pdf in export's, written out in writer's and rasterized
+in ingest's.
+"""
+
+from edits import apply
+
+#Returns what the deck's method does, a CardStore tells if anything changed.
+#Without parallel the ops that have a pool keep to one process.
+def run(deck, op, args=(), kwargs=None, call=None, parallel=False):
+	if op in getattr(deck, "POOLED", ()):
+		kwargs = dict(kwargs or {}, processes=None if parallel else 1)
+	return apply(deck, op, args, kwargs, call)
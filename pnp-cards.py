@@ -20,15 +20,39 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import json
+import os
+import sys
+import time
 from sys import argv
+from multiprocessing import cpu_count
+
+#Startup is timed from here, see report_startup
+STARTED = time.time()
 
 #Graphics
-from PyQt4.QtGui import QApplication, QMainWindow, QFileDialog
-from PyQt4.QtCore import QSettings, pyqtSlot, Qt
+from PyQt4.QtGui import (QApplication, QMainWindow, QFileDialog, QShortcut, QKeySequence, QPixmap, QAction,
+		QActionGroup, QLineEdit, QGraphicsScene)
+from PyQt4.QtCore import QSettings, QTimer, pyqtSlot, Qt
 from window import Ui_Form as Central
-
-#Print and Play own library (separated git project)
-from pnp import Card, Border, Deck, Printer
+from jobs import JobRunner
+from store import CardStore
+from export import StreamPrinter, COLORS, DPI
+from writer import ImageWriter
+from thumbs import ThumbnailCache
+from overview import OverviewView
+from project import Project
+import selection
+import profiling
+import parallel
+import ingest
+
+#Print and Play own library (separated git project) and the image and
+#array libraries behind it are slow to load; they are imported by the first
+#operation that needs them, after the window is up
+HEAVY = ("pnp", "wand.image", "numpy")
+
+IMPORTED = time.time()
 
 class MainWindow(QMainWindow, Central):
 
@@ -38,20 +62,71 @@ class MainWindow(QMainWindow, Central):
 		self.setupUi(self)
 		#self.readSettings()
 		self.show()
+		self.jobs = JobRunner(self)
+		self.deck = None
+		#Fan whole-deck transforms out to a process per core
+		self.parallel = cpu_count() > 1
+		self.thumbs = ThumbnailCache()
+		self.overview = None
+		self.profiler = None
+		self.profile_mark = 0
+		#One scene for the whole session, resets only clear it
+		self.scene = QGraphicsScene(self)
+		self.preview_view.setScene(self.scene)
+		self.preview_view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+		self.preview_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+		self.init_export_options()
+		self.init_selection()
+		self.init_split_options()
 		self.init_signals()
 		self.handler_reset()
 
 	def handler_reset(self):
-		self.deck = Deck([])
-		self.printer = Printer()
+		if self.jobs.busy():
+			self.say("Wait until the current operation finishes")
+			return
+		if self.deck is not None:
+			self.deck.close()
+		self.deck = CardStore()
+		if self.overview is not None:
+			self.overview.refresh(self.deck)
+		self.project = Project()
 		self.fichero_edit.setText("")
-		self.preview_view.setScene(self.printer.scene)
-		self.preview_view.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-		self.preview_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-		self.preview_view.show()
+		self.preview()
 		self.say("Ready")
 		self.percent(0)
 
+	#Right click on Save as: colour mode and print resolution of pdf exports
+	def init_export_options(self):
+		self.guardar_como_boton.setContextMenuPolicy(Qt.ActionsContextMenu)
+		self.export_colors = QActionGroup(self)
+		#In the order of COLORS
+		for text in ("Colour", "Greyscale", "Line art"):
+			action = QAction(text, self.export_colors)
+			action.setCheckable(True)
+			self.guardar_como_boton.addAction(action)
+		self.export_colors.actions()[0].setChecked(True)
+		self.export_downsample = QAction("Shrink cards to print resolution", self)
+		self.export_downsample.setCheckable(True)
+		self.export_downsample.setChecked(True)
+		self.guardar_como_boton.addAction(self.export_downsample)
+
+	#The decorative button makes room for a selection of cards, which wins
+	#over All and Preview while it has text
+	def init_selection(self):
+		self.pushButton_5.hide()
+		self.selection_edit = QLineEdit(self.groupBox_11)
+		self.selection_edit.setGeometry(self.pushButton_5.geometry())
+		self.selection_edit.setPlaceholderText("Cards: 1-5, 9, file:name")
+		self.selection_edit.show()
+
+	#Right click on Split: split every sheet by the grid found on it
+	def init_split_options(self):
+		self.dividir_boton.setContextMenuPolicy(Qt.ActionsContextMenu)
+		action = QAction("Find the grid of every sheet", self)
+		action.triggered.connect(self.handler_auto_split)
+		self.dividir_boton.addAction(action)
+
 	def init_signals(self):
 		self.elegir_boton.clicked.connect(self.handler_open_files)
 		self.dividir_boton.clicked.connect(self.handler_split)
@@ -69,90 +144,206 @@ class MainWindow(QMainWindow, Central):
 		self.left_crop.clicked.connect(self.handler_crop_left)
 		self.all_crop.clicked.connect(self.handler_crop_all)
 		self.reset_boton.clicked.connect(self.handler_reset)
+		self.jobs.started.connect(self.job_started)
+		self.jobs.progress.connect(self.percent)
+		self.jobs.finished.connect(self.job_finished)
+		QShortcut(QKeySequence(Qt.Key_Escape), self, self.handler_cancel)
+		QShortcut(QKeySequence.Undo, self, self.handler_undo)
+		QShortcut(QKeySequence.Redo, self, self.handler_redo)
+		QShortcut(QKeySequence.Save, self, self.handler_save_project)
+		QShortcut(QKeySequence.Open, self, self.handler_open_project)
+		QShortcut(QKeySequence("Ctrl+Shift+P"), self, self.handler_save_trace)
+		QShortcut(QKeySequence("Ctrl+G"), self, self.handler_overview)
+
+	#Widgets that would touch the deck while a job is running on it
+	def job_widgets(self):
+		return [self.groupBox_2, self.groupBox, self.groupBox_9, self.groupBox_8,
+				self.groupBox_10, self.groupBox_5, self.groupBox_11, self.groupBox_12,
+				self.quitar_boton]
+
+	def run_job(self, name, func, after=None, total=None):
+		total = len(self.deck) if total is None else total
+		profiler = self.profile()
+		#The job's thread is the one the profiler tells the peak memory of
+		def job(call):
+			profiler.watch()
+			return func(call)
+		if not self.jobs.start(name, job, total, after):
+			self.say("Wait until the current operation finishes")
+
+	#Runs func as a job and logs step in the project once it is done, only
+	#if the deck made it an undo step, so both undo the same things
+	def run_logged_job(self, name, func, step, after, total=None):
+		changed = []
+		def job(call):
+			changed.append(func(call))
+		def done():
+			if changed[0]:
+				self.project.record(*step)
+			after()
+		self.run_job(name, job, done, total)
+
+	#Whole-deck operation
+	def run_deck_job(self, name, after, op, *args, **kwargs):
+		job = lambda call: parallel.run(self.deck, op, args, kwargs, call, self.parallel)
+		self.run_logged_job(name, job, (op, args, kwargs, None), after)
+
+	#One pass over the selected cards: one progress cycle, one undo step and
+	#one preview refresh
+	def run_selection_job(self, name, indices, op, *args, **kwargs):
+		job = lambda call: parallel.run(self.deck, op, args, dict(kwargs, indices=indices), call, self.parallel)
+		self.run_logged_job(name, job, (op, args, kwargs, indices), self.preview, len(indices))
+
+	def edit_cards(self, name, op, *args, **kwargs):
+		try:
+			indices = self.selected()
+		except ValueError as e:
+			self.say(str(e))
+			return
+		if indices is not None:
+			self.run_selection_job(name, indices, op, *args, **kwargs)
+		elif self.all_selected():
+			self.run_deck_job(name, self.preview, op, *args, **kwargs)
+		else:
+			self.edit_previewed(op, *args, **kwargs)
+
+	def edit_previewed(self, op, *args, **kwargs):
+		num = self.preview_slider.value()
+		if self.deck.edit_card(num, op, *args, **kwargs):
+			self.project.record(op, args, kwargs, [num])
+		self.preview()
+
+	def handler_undo(self):
+		if self.jobs.busy():
+			return
+		if self.deck.undo():
+			self.project.undo()
+			self.say("Undone")
+			self.preview()
+		else:
+			self.say("Nothing to undo")
+
+	def handler_redo(self):
+		if self.jobs.busy():
+			return
+		if self.deck.redo():
+			self.project.redo()
+			self.say("Redone")
+			self.preview()
+		else:
+			self.say("Nothing to redo")
+
+	#The profiler wraps pnp's classes, so it is installed by the first job
+	#instead of on startup
+	def profile(self):
+		if self.profiler is None:
+			self.profiler = profiling.install()
+		return self.profiler
+
+	def job_started(self, name):
+		self.profile_mark = self.profile().mark()
+		if self.overview is not None:
+			self.overview.pause()
+		for widget in self.job_widgets():
+			widget.setEnabled(False)
+		self.reset_percent()
+		self.say("%s... (Esc to cancel)" % name)
+
+	def job_finished(self, name, status):
+		for widget in self.job_widgets():
+			widget.setEnabled(True)
+		if status:
+			self.percent(0)
+			self.say(status)
+			self.preview()
+		else:
+			self.complete_percent()
+			summary = self.profiler.summary(self.profile_mark)
+			if summary:
+				self.say("%s | %s" % (self.msg_label.text(), summary))
+
+	def handler_save_trace(self):
+		path = str(QFileDialog.getSaveFileName(self, "Save trace", "./", "Chrome trace (*.json)"))
+		if path:
+			self.profile().write(path)
+			self.say("Trace saved")
+
+	#Every card at once, double click one to preview it
+	def handler_overview(self):
+		if self.overview is None:
+			self.overview = OverviewView(self.deck, self.jobs.busy)
+			self.overview.chosen.connect(self.preview_slider.setValue)
+		self.overview.refresh()
+		self.overview.show()
+		self.overview.raise_()
+
+	def handler_cancel(self):
+		self.jobs.cancel()
 
 	def all_selected(self):
 		return self.todas_radio.isChecked()
 
+	#Indices typed in the selection box, None if it is empty
+	def selected(self):
+		text = str(self.selection_edit.text()).strip()
+		if not text:
+			return None
+		indices = selection.select(text, self.deck)
+		if not indices:
+			raise ValueError("No cards selected")
+		return indices
+
 	def handler_crop_top(self):
-		px = self.crop_spin.value()
-		if self.all_selected():
-			self.reset_percent()
-			self.deck.crop(top=px, call=self.next_percent)
-			self.complete_percent()
-		else:
-			self.deck[self.preview_slider.value()].crop(top=px)
-		self.preview()
+		self.edit_cards("Crop", "crop", top=self.crop_spin.value())
 
 	def handler_crop_right(self):
-		px = self.crop_spin.value()
-		if self.all_selected():
-			self.reset_percent()
-			self.deck.crop(right=px, call=self.next_percent)
-			self.complete_percent()
-		else:
-			self.deck[self.preview_slider.value()].crop(right=px)
-		self.preview()
+		self.edit_cards("Crop", "crop", right=self.crop_spin.value())
 
 	def handler_crop_bottom(self):
-		px = self.crop_spin.value()
-		if self.all_selected():
-			self.reset_percent()
-			self.deck.crop(bottom=px, call=self.next_percent)
-			self.complete_percent()
-		else:
-			self.deck[self.preview_slider.value()].crop(bottom=px)
-		self.preview()
+		self.edit_cards("Crop", "crop", bottom=self.crop_spin.value())
 
 	def handler_crop_left(self):
-		px = self.crop_spin.value()
-		if self.all_selected():
-			self.reset_percent()
-			self.deck.crop(left=px, call=self.next_percent)
-			self.complete_percent()
-		else:
-			self.deck[self.preview_slider.value()].crop(left=px)
-		self.preview()
+		self.edit_cards("Crop", "crop", left=self.crop_spin.value())
 
 	def handler_crop_all(self):
 		px = self.crop_spin.value()
-		if self.all_selected():
-			self.reset_percent()
-			self.deck.crop(top=px, bottom=px, left=px, right=px, call=self.next_percent)
-			self.complete_percent()
-		else:
-			self.deck[self.preview_slider.value()].crop(top=px, left=px, right=px, bottom=px)
-		self.preview()
+		self.edit_cards("Crop", "crop", top=px, bottom=px, left=px, right=px)
 
 	def handler_delete_borders(self):
-		if self.all_selected():
-			self.reset_percent()
-			self.deck.del_borders(call=self.next_percent)
-			self.complete_percent()
-		else:
-			self.deck[self.preview_slider.value()].del_border()
-		self.preview()
+		self.edit_cards("Remove borders", "del_borders")
 
 	def handler_trim(self):
-		fuzz = self.umbral_spin_2.value()
-		if self.all_selected():
-			self.reset_percent()
-			self.deck.trim(fuzz, call=self.next_percent)
-			self.complete_percent()
-		else:
-			self.deck[self.preview_slider.value()].trim(fuzz)
-		self.preview()
+		self.edit_cards("Trim", "trim", self.umbral_spin_2.value())
 
 	def handler_split(self):
 		n = self.n_spin_2.value()
 		m = self.m_spin_2.value()
 		sep = self.sep_spin.value()
 		if self.all_selected():
-			self.reset_percent()
-			self.deck.split(n, m, sep, call=self.next_percent)
-			self.complete_percent()
+			self.run_deck_job("Split", self.splited, "split", n, m, sep)
 		else:
-			card = self.deck.del_card(self.preview_slider.value())
-			self.deck.extend(card.split(n, m, sep))
+			num = self.preview_slider.value()
+			try:
+				changed = self.deck.split_card(num, n, m, sep)
+			except ValueError as e:
+				self.say(str(e))
+				return
+			if changed:
+				self.project.record("split_card", num, n, m, sep)
+			self.splited()
+
+	def handler_auto_split(self):
+		try:
+			indices = self.selected()
+		except ValueError as e:
+			self.say(str(e))
+			return
+		if indices is None and not self.all_selected():
+			indices = [self.preview_slider.value()]
+		self.run_logged_job("Split", lambda call: self.deck.auto_split(call=call, indices=indices),
+				("auto_split", (), {}, indices), self.splited)
+
+	def splited(self):
 		self.preview(0)
 		self.say("Splited")
 
@@ -160,9 +351,9 @@ class MainWindow(QMainWindow, Central):
 		n = self.n_spin_2.value()
 		m = self.m_spin_2.value()
 		sep = self.sep_spin.value()
-		self.reset_percent()
-		self.deck.join(n, m, sep, call=self.next_percent)
-		self.complete_percent()
+		self.run_deck_job("Merge", self.merged, "join", n, m, sep)
+
+	def merged(self):
 		self.preview(0)
 		self.say("Merged")
 
@@ -180,11 +371,54 @@ class MainWindow(QMainWindow, Central):
 			names = prev + ", "
 		names += ", ".join([str(el)[str(el).rfind("/")+1:] for el in files])
 		self.fichero_edit.setText(names)
-		self.reset_percent()
-		for file in files:
-			self.deck.load(file)
-			self.next_percent(files)
-		self.complete_percent()
+		files = [str(el) for el in files]
+		card_size = str(self.card_size_combo.currentText())
+		n, m = self.n_spin_2.value(), self.m_spin_2.value()
+		self.loaded_from = len(self.deck)
+		#The whole load is one undo step, of the pages that made it in: a file
+		#cut short by a cancel or an error is logged with the pages it got
+		def load(call):
+			state = self.deck.state()
+			steps = []
+			loaded = [0]
+			def add(blob, source, size):
+				loaded[0] += 1
+				self.page_loaded(self.deck.stored(blob, source, size))
+			try:
+				#Both open every pdf, so they are done here rather than before
+				#the job. Don't rasterize beyond what the chosen card size will
+				#print; progress goes by the pages counted.
+				dpis = [ingest.target_dpi(file, card_size, n, m) for file in files]
+				pages = range(sum(ingest.count(file) for file in files))
+				for file, dpi in zip(files, dpis):
+					loaded[0] = 0
+					try:
+						ingest.ingest(self.deck, file, None, dpi, lambda: call(pages), add)
+					finally:
+						if loaded[0] > 0:
+							whole = loaded[0] == ingest.count(file)
+							steps.append(["load", file, None if whole else "1-%d" % loaded[0], dpi])
+			finally:
+				self.jobs.later(lambda: self.load_done(state, steps))
+		self.run_job("Load", load, self.loaded, len(files))
+
+	def load_done(self, state, steps):
+		if self.deck.commit(state):
+			self.project.record_steps(steps)
+
+	#Pages show up in the preview as soon as they are rasterized. Their files
+	#are written on the job's thread, the GUI only adds them to the deck.
+	def page_loaded(self, entry):
+		self.jobs.later(lambda: self.show_page(entry))
+
+	def show_page(self, entry):
+		self.deck.add_entry(entry)
+		if len(self.deck) == self.loaded_from + 1:
+			self.preview(self.loaded_from)
+		else:
+			self.preview_slider.setMaximum(len(self.deck)-1)
+
+	def loaded(self):
 		self.preview(0)
 		self.say("Loaded")
 
@@ -195,29 +429,70 @@ class MainWindow(QMainWindow, Central):
 		card_size = str(self.card_size_combo.currentText())
 		orientation = str(self.orientation_combo.currentText())
 		paper_size = str(self.paper_size_combo.currentText())
-		self.percent(30)
 		if format == "Separated images":
-			self.printer.config(deck = self.deck, print_path = str(name))
-			self.percent(35)
-			self.printer.print_images()
-		elif format == "Pdf from images":
-			self.printer.config(deck = self.deck, card_size = str(self.card_size_combo.currentText()),
+			writer = ImageWriter()
+			writer.config(deck = self.deck, print_path = str(name), parallel = self.parallel)
+			self.run_job("Save", writer.print_images, self.saved, len(self.deck))
+			return
+		#Pdf sheets are written one at a time, on the job's thread
+		printer = StreamPrinter()
+		#Saved projects keep their encoded cards to encode only the changed ones
+		printer.config(sheets = self.project.sheets_dir(), parallel = self.parallel,
+				colors = COLORS[self.export_colors.actions().index(self.export_colors.checkedAction())],
+				dpi = DPI if self.export_downsample.isChecked() else 0)
+		if format == "Pdf from images":
+			printer.config(deck = self.deck, card_size = str(self.card_size_combo.currentText()),
 					paper_size = str(self.paper_size_combo.currentText()),
 					print_path = str(name) + ".pdf")
-			self.percent(35)
-			self.printer.print_pdf()
+			job = printer.print_pdf
 		elif format == "Pdf from grid":
-			self.printer.config(deck = self.deck, orientation = str(self.orientation_combo.currentText()),
+			printer.config(deck = self.deck, orientation = str(self.orientation_combo.currentText()),
 					paper_size = str(self.paper_size_combo.currentText()),
 					print_path = str(name) + ".pdf")
-			self.percent(35)
-			self.printer.print_grid()
-		self.percent(100)
+			job = printer.print_grid
+		#The printer counts the pages itself
+		self.run_job("Save", job, self.saved, 1)
+
+	def handler_save_project(self):
+		path = self.project.path
+		if path is None:
+			path = str(QFileDialog.getSaveFileName(self, "Save project", "./", "Projects (*.pnp)"))
+			if not path:
+				return
+			if not path.endswith(".pnp"):
+				path += ".pnp"
+		self.project.save(path)
+		self.say("Project saved")
+
+	def handler_open_project(self):
+		if self.jobs.busy():
+			self.say("Wait until the current operation finishes")
+			return
+		path = str(QFileDialog.getOpenFileName(self, "Open project", "./", "Projects (*.pnp)"))
+		if not path:
+			return
+		try:
+			project = Project.open(path)
+			stale = project.stale_sources()
+		except (IOError, ValueError, KeyError) as e:
+			self.say("Can't open project: %s" % e)
+			return
+		self.handler_reset()
+		self.project = project
+		self.fichero_edit.setText(", ".join(os.path.basename(file) for file in project.sources()))
+		def opened():
+			self.preview(0)
+			self.say("Project opened" if not stale else "Project opened, %d source(s) changed" % len(stale))
+		self.run_job("Open project", lambda call: project.replay(self.deck, call, self.parallel),
+				opened, len(project.log))
+
+	def saved(self):
 		self.say("Save Completed")
 
 	def handler_delete_card(self):
 		num = self.preview_slider.value()
 		self.deck.del_card(num)
+		self.project.record("del_card", num)
 		self.say("Card deleted")
 		if num < len(self.deck):
 			self.preview(num)
@@ -225,18 +500,23 @@ class MainWindow(QMainWindow, Central):
 			self.preview(-1)
 
 	def handler_black_borders(self):
-		wide = self.border_spin.value()
-		self.reset_percent()
-		self.deck.borders(Border.black, wide, call=self.next_percent)
-		self.complete_percent()
-		self.preview()
+		self.add_borders("black")
 
 	def handler_white_borders(self):
+		self.add_borders("white")
+
+	#Borders go on every card unless some are selected
+	def add_borders(self, color):
 		wide = self.border_spin.value()
-		self.reset_percent()
-		self.deck.borders(Border.white, wide, call=self.next_percent)
-		self.complete_percent()
-		self.preview()
+		try:
+			indices = self.selected()
+		except ValueError as e:
+			self.say(str(e))
+			return
+		if indices is None:
+			self.run_deck_job("Borders", self.preview, "borders", color, wide)
+		else:
+			self.run_selection_job("Borders", indices, "borders", color, wide)
 
 	def say(self, text):
 		self.msg_label.setText(text)
@@ -258,8 +538,32 @@ class MainWindow(QMainWindow, Central):
 		ldeck = len(self.deck)
 		self.preview_slider.setMaximum((ldeck-1) if ldeck > 0 else 0)
 		num = self.preview_slider.value() if num is None else num
-		pm = self.printer.preview_card(self.deck[num])
-		self.preview_view.fitInView(pm)
+		scene = self.scene
+		scene.clear()
+		if ldeck == 0:
+			return
+		num = num % ldeck
+		#Moving through the cards leaves the overview alone, only changes to
+		#the deck refresh it
+		if self.overview is not None and self.overview.isVisible():
+			self.overview.sync()
+		size = self.preview_view.viewport().size()
+		img = self.thumbs.card(self.deck, num, size.width(), size.height())
+		pm = scene.addPixmap(QPixmap.fromImage(img))
+		scene.setSceneRect(pm.boundingRect())
+		self.preview_view.fitInView(pm, Qt.KeepAspectRatio)
+		if not self.jobs.busy():
+			self.thumbs.prefetch(self.deck, num, size.width(), size.height())
+
+	def closeEvent(self, e):
+		self.jobs.cancel()
+		self.jobs.wait()
+		self.deck.close()
+		if self.overview is not None:
+			self.overview.close()
+		if os.environ.get("PNP_CARDS_TRACE"):
+			self.profile().write(os.environ["PNP_CARDS_TRACE"])
+		QMainWindow.closeEvent(self, e)
 
 #	@pyqtSlot()
 #	def closeEvent(self, e):
@@ -273,9 +577,21 @@ class MainWindow(QMainWindow, Central):
 #		self.restoreGeometry(settings.value("geometry").toByteArray())
 #		self.restoreState(settings.value("windowState").toByteArray())
 
+#With PNP_CARDS_STARTUP set the program prints how long it took to show a
+#usable window, as JSON, and quits; bench.py's startup target runs it
+def report_startup(app):
+	app.processEvents()
+	now = time.time()
+	sys.stdout.write(json.dumps({"imports_seconds": round(IMPORTED - STARTED, 4),
+			"window_seconds": round(now - STARTED, 4), "modules": len(sys.modules),
+			"heavy": [name for name in HEAVY if name in sys.modules]}) + "\n")
+	sys.stdout.flush()
+	app.quit()
 
 if __name__ == "__main__":
 	app = QApplication(argv)
 	window = MainWindow()
 	window.show()
+	if os.environ.get("PNP_CARDS_STARTUP"):
+		QTimer.singleShot(0, lambda: report_startup(app))
 	app.exec_()
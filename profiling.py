@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Timing and memory of every Deck, Card and Printer call, and of the stages
+of this program around them (rasterization, rendering, pdf writing).
+Methods are wrapped in place once install() runs. Every call becomes a
+span with its duration and number of cards, and top level spans also
+with the peak RSS; spans can be summarized for the status bar or written
+as a Chrome trace (chrome://tracing, Perfetto). Only the latest MAX_SPANS
+are kept, so a long session doesn't grow without end.
+
+The peak RSS is the whole process's, so only the top level spans of one
+thread, the watched one, reset and read it, and only that thread's spans
+are summarized. It is the thread that installed the profiler until a job
+calls watch() from its own.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+MAX_SPANS = 20000
+
+#Linux keeps the peak RSS in VmHWM and resets it on "5" to clear_refs
+def reset_peak():
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+	except (IOError, OSError):
+		pass
+
+def peak_kb():
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1])
+	except (IOError, OSError):
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def cards_of(obj, args):
+	for candidate in (obj, getattr(obj, "deck", None)):
+		try:
+			return len(candidate)
+		except TypeError:
+			pass
+	return 1
+
+class Profiler(object):
+
+	def __init__(self, max_spans=MAX_SPANS):
+		self.spans = deque(maxlen=max_spans)
+		#Spans ever recorded; marks count from the first one
+		self.count = 0
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.origin = time.time()
+		self.owner = threading.current_thread().name
+
+	def depth(self):
+		return getattr(self.local, "depth", 0)
+
+	#Makes the calling thread the watched one, returns a mark
+	def watch(self):
+		with self.lock:
+			self.owner = threading.current_thread().name
+			return self.count
+
+	def call(self, name, func, cards, *args, **kwargs):
+		depth = self.depth()
+		thread = threading.current_thread().name
+		#Reading the peak costs a read of /proc, nested spans go without
+		peak = depth == 0 and thread == self.owner
+		if peak:
+			reset_peak()
+		self.local.depth = depth + 1
+		start = time.time()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			self.local.depth = depth
+			span = {"name": name, "start": start - self.origin, "seconds": time.time() - start,
+					"cards": cards, "peak_kb": peak_kb() if peak else None, "depth": depth,
+					"thread": thread}
+			with self.lock:
+				self.spans.append(span)
+				self.count += 1
+
+	def wrap(self, name, func, count=cards_of):
+		profiler = self
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			cards = count(args[0] if args else None, args)
+			return profiler.call(name, func, cards, *args, **kwargs)
+		wrapper.profiled = True
+		return wrapper
+
+	def instrument(self, owner, names, label=None, count=cards_of):
+		label = getattr(owner, "__name__", str(owner)) if label is None else label
+		for name in names:
+			func = getattr(owner, name, None)
+			if func is None or getattr(func, "profiled", False):
+				continue
+			if isinstance(owner, type):
+				func = owner.__dict__.get(name, func)
+			setattr(owner, name, self.wrap("%s.%s" % (label, name), func, count))
+
+	def mark(self):
+		with self.lock:
+			return self.count
+
+	#Spans since mark that are still kept
+	def since(self, mark=0):
+		with self.lock:
+			first = self.count - len(self.spans)
+			return list(self.spans)[max(0, mark - first):]
+
+	#Top level spans of the watched thread since mark, slowest first:
+	#"Deck.trim 2.31s 100 cards (43/s) peak 410 MB"
+	def summary(self, mark=0, limit=2):
+		spans = [span for span in self.since(mark) if span["depth"] == 0 and span["thread"] == self.owner]
+		spans.sort(key=lambda span: -span["seconds"])
+		parts = []
+		for span in spans[:limit]:
+			rate = " (%d/s)" % (span["cards"]/span["seconds"]) if span["seconds"] > 0 else ""
+			peak = " peak %d MB" % (span["peak_kb"]//1024) if span["peak_kb"] is not None else ""
+			parts.append("%s %.2fs %d cards%s%s" % (span["name"], span["seconds"],
+					span["cards"], rate, peak))
+		return ", ".join(parts)
+
+	def write(self, path):
+		pid = os.getpid()
+		events = [{"name": span["name"], "ph": "X", "pid": pid, "tid": span["thread"],
+				"ts": int(span["start"]*1e6), "dur": int(span["seconds"]*1e6),
+				"args": dict((key, span[key]) for key in ("cards", "peak_kb") if span[key] is not None)}
+				for span in self.since()]
+		with open(path, "w") as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+_profiler = []
+
+def one(obj, args):
+	return 1
+
+#Wraps the hot paths once and returns the profiler
+def install():
+	if _profiler:
+		return _profiler[0]
+	profiler = Profiler()
+	from pnp import Card, Deck, Printer
+	import store, export, writer, ingest, detect
+	profiler.instrument(Deck, ["load", "split", "join", "trim", "crop", "borders", "del_borders"])
+	profiler.instrument(Card, ["crop", "trim", "del_border", "split"], count=one)
+	profiler.instrument(Printer, ["print_pdf", "print_grid", "print_images", "preview_card"])
+	profiler.instrument(store.CardStore, ["load", "split", "auto_split", "join", "trim", "crop", "borders",
+			"del_borders", "bake_all"])
+	profiler.instrument(store.CardStore, ["rendered"], count=one)
+	profiler.instrument(export.StreamPrinter, ["print_pdf", "print_grid"])
+	profiler.instrument(writer.ImageWriter, ["print_images"])
+	profiler.instrument(ingest, ["ingest"], count=one)
+	profiler.instrument(detect, ["trim_edits"])
+	_profiler.append(profiler)
+	return profiler
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Project files. A project is the log of everything done to the deck, from
+loading the sources to every edit on all cards or on a single one, saved
+as JSON next to a folder with the encoded cards of its last export. Opening
+it replays the log; pages and cards that didn't change come from the caches.
+"""
+
+import json
+import os
+
+import cache
+import parallel
+
+VERSION = 1
+
+#Steps are lists: ["load", file, pages, dpi], [op, args, kwargs, cards]
+#with cards None for the whole deck, ["del_card", num] and
+#["split_card", num, n, m, sep]
+def run_step(deck, step, call=None, use_pool=False):
+	op = step[0]
+	if op == "load":
+		file, pages, dpi = step[1:]
+		deck.load(file, pages, dpi, call)
+	elif op == "del_card":
+		deck.del_card(step[1])
+	elif op == "split_card":
+		num, n, m, sep = step[1:]
+		if hasattr(deck, "split_card"):
+			deck.split_card(num, n, m, sep)
+		else:
+			card = deck.del_card(num)
+			deck.extend(card.split(n, m, sep))
+	else:
+		args, kwargs, indices = step[1:]
+		if indices is not None:
+			kwargs = dict(kwargs, indices=indices)
+		parallel.run(deck, op, args, kwargs, call, use_pool)
+
+class Project(object):
+
+	def __init__(self, path=None, log=None):
+		self.path = path
+		self.log = [] if log is None else log
+		#Steps in every undo step of the deck, and the steps undone
+		self.units = [1]*len(self.log)
+		self.undone = []
+		self.changed = False
+
+	def record(self, *step):
+		self.record_steps([list(step)])
+
+	#Several steps the deck undoes at once, like the files of one load
+	def record_steps(self, steps):
+		self.log.extend(steps)
+		self.units.append(len(steps))
+		self.undone = []
+		self.changed = True
+
+	def undo(self):
+		if self.units:
+			count = self.units.pop()
+			self.undone.append(self.log[len(self.log) - count:])
+			del self.log[len(self.log) - count:]
+			self.changed = True
+
+	def redo(self):
+		if self.undone:
+			steps = self.undone.pop()
+			self.log.extend(steps)
+			self.units.append(len(steps))
+			self.changed = True
+
+	def sources(self):
+		return [step[1] for step in self.log if step[0] == "load"]
+
+	#Folder with the encoded cards of the last export, to reuse the unchanged ones
+	def sheets_dir(self):
+		return None if self.path is None else os.path.splitext(self.path)[0] + "-sheets"
+
+	def save(self, path=None):
+		self.path = self.path if path is None else path
+		sources = [{"file": file, "hash": cache.file_hash(file)} for file in self.sources() if os.path.exists(file)]
+		with open(self.path, "w") as f:
+			json.dump({"version": VERSION, "sources": sources, "log": self.log}, f, indent=1)
+		self.changed = False
+
+	@classmethod
+	def open(cls, path):
+		with open(path) as f:
+			data = json.load(f)
+		if data.get("version") != VERSION:
+			raise ValueError("%s is not a project this version can open" % path)
+		return cls(path, data["log"])
+
+	#Sources that changed or went missing since the project was saved
+	def stale_sources(self):
+		with open(self.path) as f:
+			saved = dict((source["file"], source["hash"]) for source in json.load(f)["sources"])
+		return [file for file in self.sources()
+				if not os.path.exists(file) or cache.file_hash(file) != saved.get(file)]
+
+	def replay(self, deck, call=None, use_pool=False):
+		for step in self.log:
+			run_step(deck, step, None, use_pool)
+			if call is not None:
+				call()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Card selections, as typed: comma separated card numbers and ranges,
+counted from 1 like the preview ("1-5, 9, 12-" goes on to the last card),
+and "file:name" for every card loaded from a file whose name contains
+name. The parts add up.
+"""
+
+import os
+
+def source(deck, num):
+	meta = getattr(deck, "meta", None)
+	return None if meta is None else meta[num].get("source")
+
+def from_file(deck, name):
+	name = name.strip().lower()
+	return [num for num in range(len(deck))
+			if source(deck, num) is not None and name in os.path.basename(source(deck, num)).lower()]
+
+#Sorted indices of the cards in text, ValueError if it doesn't parse
+def select(text, deck):
+	total = len(deck)
+	chosen = set()
+	for part in text.split(","):
+		part = part.strip()
+		if not part:
+			continue
+		if part.lower().startswith("file:"):
+			found = from_file(deck, part[5:])
+			if not found:
+				raise ValueError("No cards from a file like %r" % part[5:].strip())
+			chosen.update(found)
+			continue
+		try:
+			if "-" in part:
+				first, last = part.split("-", 1)
+				first = int(first) if first.strip() else 1
+				last = int(last) if last.strip() else total
+			else:
+				first = last = int(part)
+		except ValueError:
+			raise ValueError("Can't read %r as cards, use 1-5, 9 or file:name" % part)
+		if first < 1 or last > total or first > last:
+			raise ValueError("Cards %s are out of 1-%d" % (part, total))
+		chosen.update(range(first - 1, last))
+	return sorted(chosen)
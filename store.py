@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Disk backed card storage. A CardStore behaves like a pnp Deck but only
+keeps metadata in memory: the pixels of every card live in a file of its
+own and are decoded on demand, with a small LRU of decoded cards.
+Crops, trims and borders are only recorded as edits (see edits.py) and
+rendered when a card is read. Cards split from a sheet are views of it:
+they share its file and only add a crop, until one of them is written.
+
+Every change can be undone and redone. An edit is undone by taking it off
+the cards it went to. Changes to the cards themselves (splits, joins,
+deletions, loads) save the cards as they were, sharing their files
+instead of copying them; the oldest steps are forgotten once there are
+too many or the files only they keep exceed the history's byte budget.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from itertools import count
+from threading import Lock
+
+from imaging import to_array, to_blob, from_blob, clone, cards
+from edits import apply, edit, render
+import detect
+import ingest
+
+HISTORY_STEPS = 100
+HISTORY_BYTES = 512*1024**2
+
+#Crops that cut an n x m sheet, row by row, with sep pixels between rows
+#of cards and col_sep (sep too if None) between columns
+def regions(size, n, m, sep, col_sep=None):
+	width, height = size
+	col_sep = sep if col_sep is None else col_sep
+	cell_w = (width - (m-1)*col_sep) // m
+	cell_h = (height - (n-1)*sep) // n
+	if cell_w <= 0 or cell_h <= 0:
+		raise ValueError("A %dx%d sheet can't be split in %dx%d with %d px between cards" % (width, height, n, m, max(sep, col_sep)))
+	for row in range(n):
+		for col in range(m):
+			left, top = col*(cell_w + col_sep), row*(cell_h + sep)
+			sides = {"top": top, "left": left, "right": width - left - cell_w, "bottom": height - top - cell_h}
+			yield dict((side, px) for side, px in sides.items() if px)
+
+class CardStore(object):
+
+	#Operations that measure the cards in a process pool, of processes
+	POOLED = ("trim", "del_borders")
+
+	def __init__(self, path=None, cache_size=16, history_steps=HISTORY_STEPS, history_bytes=HISTORY_BYTES):
+		self.own_path = path is None
+		self.path = tempfile.mkdtemp(prefix="pnp-cards-") if path is None else path
+		self.cache_size = cache_size
+		self.meta = []
+		self.cache = OrderedDict()
+		self.sheets = OrderedDict()
+		self.names = count()
+		self.ids = count()
+		#Views, history steps and preview workers share files; the workers
+		#let go of theirs on their own threads
+		self.refs = {}
+		self.refs_lock = Lock()
+		#Steps are ("edits", [(entry, edit)]) or ("cards", state)
+		self.history = []
+		self.future = []
+		self.history_steps = history_steps
+		self.history_bytes = history_bytes
+		#Steps pushed, undone or redone, for views to tell the deck changed
+		self.changes = 0
+
+	def __len__(self):
+		return len(self.meta)
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def __getitem__(self, num):
+		entry = self.meta[num]
+		card = self.cache.pop(entry["id"], None)
+		if card is None:
+			card = self.rendered(entry)
+		self.remember(entry["id"], card)
+		return card
+
+	def remember(self, key, card, cache=None, size=None):
+		cache = self.cache if cache is None else cache
+		cache[key] = card
+		while len(cache) > (self.cache_size if size is None else size):
+			cache.popitem(last=False)
+
+	def read(self, entry):
+		with open(entry["file"], "rb") as f:
+			return f.read()
+
+	def blob(self, num):
+		return self.read(self.meta[num])
+
+	#The views of a sheet are usually read one after another, so the last
+	#decoded sheets are kept around
+	def decoded(self, entry):
+		key = (entry["file"], entry["version"])
+		card = self.sheets.pop(key, None)
+		if card is None:
+			card = from_blob(self.read(entry))
+		self.remember(key, card, self.sheets, 2)
+		return clone(card)
+
+	def rendered(self, entry):
+		return render(self.decoded(entry), entry["edits"])
+
+	def size(self, entry):
+		if entry["size"] is None:
+			entry["size"] = tuple(self.decoded(entry).img.size)
+		return entry["size"]
+
+	#Size after the pending edits, when they are only crops and borders;
+	#trims and border removals have to be rendered to know
+	def rendered_size(self, entry):
+		if any(op not in ("crop", "borders") for op, args, kwargs in entry["edits"]):
+			return None
+		width, height = self.size(entry)
+		for op, args, sides in entry["edits"]:
+			if op == "borders":
+				width, height = width + 2*args[1], height + 2*args[1]
+			else:
+				width -= sides.get("left", 0) + sides.get("right", 0)
+				height -= sides.get("top", 0) + sides.get("bottom", 0)
+		return width, height
+
+	def bake(self, entry):
+		card = self.rendered(entry)
+		self.write(entry, to_blob(card), card.img.size)
+		entry["edits"] = []
+
+	#Renders every pending edit into the files, they can't be undone after
+	def bake_all(self, call=None):
+		self.forget(self.history)
+		self.forget(self.future)
+		for entry in self.meta:
+			if entry["edits"]:
+				self.bake(entry)
+			if call is not None:
+				call()
+
+	#Changes whenever what the card looks like may have changed
+	def key(self, num):
+		entry = self.meta[num]
+		return (entry["file"], entry["version"], repr(entry["edits"]))
+
+	#Identifies what a card will look like, also across runs
+	def fingerprint(self, num):
+		entry = self.meta[num]
+		if entry["hash"] is None:
+			entry["hash"] = hashlib.sha1(self.read(entry)).hexdigest()
+		edits = json.dumps(entry["edits"], sort_keys=True)
+		return hashlib.sha1((entry["hash"] + edits).encode("utf-8")).hexdigest()
+
+	#Everything needed to render a card away from the store
+	def snapshot(self, num):
+		entry = self.meta[num]
+		return self.read(entry), list(entry["edits"])
+
+	#Writing to a view gives it a file of its own. Files are replaced, not
+	#written over, as they may be hard links to another store's.
+	def write(self, entry, blob, size=None):
+		if entry["file"] is None or self.refs[entry["file"]] > 1:
+			if entry["file"] is not None:
+				self.unref(entry["file"])
+			entry["file"] = self.new_file()
+			self.ref(entry["file"])
+		with open(entry["file"] + ".new", "wb") as f:
+			f.write(blob)
+		os.rename(entry["file"] + ".new", entry["file"])
+		entry["bytes"] = len(blob)
+		entry["version"] += 1
+		entry["size"] = None if size is None else tuple(size)
+		entry["hash"] = None
+		self.cache.pop(entry["id"], None)
+
+	def new_file(self):
+		return os.path.join(self.path, "%08d.card" % next(self.names))
+
+	def entry(self, source=None):
+		return {"id": next(self.ids), "file": None, "source": source, "bytes": 0,
+				"version": 0, "size": None, "hash": None, "edits": []}
+
+	def view(self, entry, edits):
+		view = dict(entry, id=next(self.ids), edits=list(entry["edits"]) + edits)
+		self.ref(view["file"])
+		return view
+
+	#A new entry, not yet part of the deck
+	def stored(self, blob, source=None, size=None):
+		entry = self.entry(source)
+		self.write(entry, blob, size)
+		return entry
+
+	def add_entry(self, entry):
+		self.meta.append(entry)
+
+	def add_blob(self, blob, source=None, size=None):
+		self.add_entry(self.stored(blob, source, size))
+
+	#Every card of another store, pending edits and known hashes included.
+	#Files are hard linked where the file system allows, and views keep
+	#sharing theirs, so no card is read.
+	def extend_from(self, other):
+		files = {}
+		for source in other.meta:
+			if source["file"] not in files:
+				files[source["file"]] = self.new_file()
+				try:
+					os.link(source["file"], files[source["file"]])
+				except (AttributeError, OSError):
+					shutil.copyfile(source["file"], files[source["file"]])
+			entry = dict(source, id=next(self.ids), file=files[source["file"]], edits=list(source["edits"]))
+			self.ref(entry["file"])
+			self.meta.append(entry)
+
+	def del_card(self, num):
+		card = self[num]
+		state = self.state()
+		self.drop(self.meta.pop(num))
+		self.commit(state)
+		return card
+
+	#The card's pieces go at the end of the deck, as views of it
+	def split_card(self, num, n, m, sep):
+		state = self.state()
+		try:
+			entry = self.meta[num]
+			size = self.rendered_size(entry)
+			if size is None:
+				self.bake(entry)
+				size = self.size(entry)
+			pieces = [self.view(entry, [edit("crop", **sides)]) for sides in regions(size, n, m, sep)]
+		except:
+			self.forget([("cards", state)])
+			raise
+		self.drop(self.meta.pop(num))
+		self.meta.extend(pieces)
+		return self.commit(state)
+
+	def clear(self):
+		for entry in self.meta:
+			self.drop(entry)
+		self.meta = []
+		self.cache.clear()
+		self.sheets.clear()
+		self.forget(self.history)
+		self.forget(self.future)
+
+	def close(self):
+		self.clear()
+		if self.own_path:
+			shutil.rmtree(self.path, True)
+
+	#Pages are rasterized in parallel and stored as they come
+	def load(self, file, pages=None, dpi=None, call=None):
+		state = self.state()
+		try:
+			ingest.ingest(self, file, pages, dpi, call)
+		finally:
+			self.commit(state)
+
+	def drop(self, entry):
+		self.cache.pop(entry["id"], None)
+		self.unref(entry["file"])
+
+	def ref(self, file):
+		with self.refs_lock:
+			self.refs[file] = self.refs.get(file, 0) + 1
+
+	def unref(self, file):
+		with self.refs_lock:
+			self.refs[file] -= 1
+			if self.refs[file] > 0:
+				return
+			del self.refs[file]
+		try:
+			os.remove(file)
+		except OSError:
+			#Closed while a worker still held it
+			pass
+
+	#The file and edits of a card, its file kept for a worker thread to
+	#read even if the card changes or goes away; release it when done
+	def hold(self, num):
+		entry = self.meta[num]
+		self.ref(entry["file"])
+		return entry["file"], list(entry["edits"])
+
+	def release(self, file):
+		self.unref(file)
+
+	#One history step per call, so undo drops the edit from all its cards.
+	#Like commit, these return whether there was a step to push.
+	def record(self, edit, indices=None, call=None):
+		indices = range(len(self)) if indices is None else indices
+		step = []
+		for num in indices:
+			step.append((num, edit))
+			if call is not None:
+				call()
+		return self.record_many(step)
+
+	#(card, edit) pairs, a different edit for each card
+	def record_many(self, pairs):
+		step = []
+		for num, edit in pairs:
+			entry = self.meta[num]
+			entry["edits"].append(edit)
+			self.cache.pop(entry["id"], None)
+			step.append((entry, edit))
+		if step:
+			self.push(("edits", step))
+		return bool(step)
+
+	def edit_card(self, num, op, *args, **kwargs):
+		return apply(self, op, args, dict(kwargs, indices=[num]))
+
+	#The cards as they are, as (entry, copy) pairs. Copies hold a reference
+	#to their files, so writing to a card afterwards copies it first.
+	def state(self):
+		saved = []
+		for entry in self.meta:
+			self.ref(entry["file"])
+			saved.append((entry, dict(entry, edits=list(entry["edits"]))))
+		return saved
+
+	#Brings back the cards of a state, the same entries as before so the
+	#edit steps around it still find them
+	def restore(self, state):
+		old = [entry["file"] for entry in self.meta]
+		for entry, copy in state:
+			entry.clear()
+			entry.update(copy)
+			entry["edits"] = list(copy["edits"])
+		self.meta = [entry for entry, copy in state]
+		for file in old:
+			self.unref(file)
+		self.cache.clear()
+
+	#Makes the change since state one undo step, unless nothing changed;
+	#True if it did
+	def commit(self, state):
+		before = [(entry, copy["file"], copy["version"], copy["edits"]) for entry, copy in state]
+		after = [(entry, entry["file"], entry["version"], entry["edits"]) for entry in self.meta]
+		if before == after:
+			self.forget([("cards", state)])
+			return False
+		self.push(("cards", state))
+		return True
+
+	def push(self, step):
+		self.changes += 1
+		self.history.append(step)
+		self.forget(self.future)
+		self.future = []
+		while self.history and (len(self.history) > self.history_steps or self.retained() > self.history_bytes):
+			self.forget([self.history.pop(0)])
+
+	def forget(self, steps):
+		for kind, data in steps:
+			if kind == "cards":
+				for entry, copy in data:
+					self.unref(copy["file"])
+		del steps[:]
+
+	#Bytes of the files only the history keeps
+	def retained(self):
+		live = set(entry["file"] for entry in self.meta)
+		files = {}
+		for kind, data in self.history + self.future:
+			if kind == "cards":
+				for entry, copy in data:
+					if copy["file"] not in live:
+						files[copy["file"]] = copy["bytes"]
+		return sum(files.values())
+
+	#Undoing a step leaves what undoes it in the other list
+	def step_back(self, steps, others, forward):
+		if not steps:
+			return False
+		self.changes += 1
+		kind, data = steps.pop()
+		if kind == "edits":
+			for entry, edit in (data if forward else reversed(data)):
+				if forward:
+					entry["edits"].append(edit)
+				elif entry["edits"] and entry["edits"][-1] == edit:
+					entry["edits"].pop()
+				self.cache.pop(entry["id"], None)
+			others.append((kind, data))
+		else:
+			others.append(("cards", self.state()))
+			self.restore(data)
+		return True
+
+	def undo(self):
+		return self.step_back(self.history, self.future, False)
+
+	def redo(self):
+		return self.step_back(self.future, self.history, True)
+
+	def crop(self, call=None, indices=None, **sides):
+		return self.record(edit("crop", **sides), indices, call)
+
+	#With numpy the content is measured now and recorded as crops
+	def trim(self, fuzz, call=None, indices=None, processes=None):
+		if not detect.available():
+			return self.record(edit("trim", fuzz), indices, call)
+		return self.record_many(detect.trim_edits(self, fuzz, call, indices, processes))
+
+	def del_borders(self, call=None, indices=None, processes=None):
+		if not detect.available():
+			return self.record(edit("del_borders"), indices, call)
+		return self.record_many(detect.border_edits(self, call, indices, processes))
+
+	def borders(self, color, wide, call=None, indices=None):
+		return self.record(edit("borders", color, wide), indices, call)
+
+	#Swaps the cards for the ones made from them, or keeps them all if making
+	#them failed or was cancelled
+	def rebuild(self, make, call=None):
+		state = self.state()
+		new = []
+		try:
+			for entry in self.meta:
+				new.extend(make(entry))
+				if call is not None:
+					call()
+		except:
+			for entry in new:
+				self.drop(entry)
+			self.forget([("cards", state)])
+			raise
+		for entry in self.meta:
+			self.drop(entry)
+		self.meta = new
+		return self.commit(state)
+
+	#Operations that change the number of cards run one group at a time,
+	#so at most one group is decoded. Pending edits are rendered first and
+	#can't be undone afterwards.
+	def groups(self, size, op, args=(), kwargs=None, call=None):
+		kwargs = kwargs or {}
+		starts = set(range(0, len(self.meta), size))
+		index = dict((entry["id"], num) for num, entry in enumerate(self.meta))
+		from pnp import Deck
+		def make(entry):
+			start = index[entry["id"]]
+			if start not in starts:
+				return []
+			group = self.meta[start:start+size]
+			deck = Deck([self.rendered(member) for member in group])
+			getattr(deck, op)(*args, **kwargs)
+			return [self.stored(to_blob(card), group[0]["source"], card.img.size) for card in cards(deck)]
+		return self.rebuild(make, call)
+
+	#Split cards start as views of their sheet: nothing is decoded or copied,
+	#each one shares the sheet's file and adds the crop of its region
+	def split(self, n, m, sep, call=None):
+		def make(entry):
+			size = self.rendered_size(entry)
+			if size is None:
+				self.bake(entry)
+				size = self.size(entry)
+			return [self.view(entry, [edit("crop", **sides)]) for sides in regions(size, n, m, sep)]
+		return self.rebuild(make, call)
+
+	#Every sheet (or those in indices) split by the grid found on it, as
+	#views like split's; sheets with a single card stay as they are
+	def auto_split(self, fuzz=detect.GRID_FUZZ, call=None, indices=None):
+		if not detect.available():
+			raise RuntimeError("Finding the grid of a sheet needs numpy")
+		chosen = None if indices is None else set(self.meta[num]["id"] for num in indices)
+		def make(entry):
+			if chosen is not None and entry["id"] not in chosen:
+				return [self.view(entry, [])]
+			card = self.rendered(entry)
+			found = detect.grid(to_array(card), fuzz)
+			if found is None:
+				return [self.view(entry, [])]
+			margins = found["crop"]
+			width, height = card.img.size
+			inner = (width - margins.get("left", 0) - margins.get("right", 0),
+					height - margins.get("top", 0) - margins.get("bottom", 0))
+			first = [edit("crop", **margins)] if margins else []
+			return [self.view(entry, first + [edit("crop", **sides)])
+					for sides in regions(inner, found["n"], found["m"], found["row_sep"], found["col_sep"])]
+		return self.rebuild(make, call)
+
+	#Merges every n*m consecutive cards into one
+	def join(self, n, m, sep, call=None):
+		return self.groups(n*m, "join", (n, m, sep), None, call)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Preview thumbnails. Cards are rendered once, scaled down to the preview
+size and kept in an LRU keyed by the card's content, so scrubbing the
+slider over cards already seen costs nothing. Neighbouring cards are
+rendered ahead of time on a background thread, which also reads their
+files: the slider only queues which file and edits to render. The views of
+a split sheet share its file, which is read and decoded once for all of
+them.
+"""
+
+from collections import OrderedDict
+from threading import Lock, Thread
+try:
+	from Queue import Queue, Empty
+except ImportError:
+	from queue import Queue, Empty
+
+from PyQt4.QtCore import Qt
+
+from imaging import from_blob, to_qimage, clone
+from edits import render
+
+def scaled(card, width, height):
+	return to_qimage(card).scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+def thumbnail(blob, edits, width, height):
+	return scaled(render(from_blob(blob), edits), width, height)
+
+def held_blob(store, file):
+	try:
+		with open(file, "rb") as f:
+			return f.read()
+	finally:
+		store.release(file)
+
+#Thumbnail of a file held for this thread with CardStore.hold, let go of
+#once it is read
+def held_thumbnail(store, file, edits, width, height):
+	return thumbnail(held_blob(store, file), edits, width, height)
+
+#[(key, thumbnail)] of several views, [(key, edits)], of one file held
+#once for each of them
+def held_thumbnails(store, file, views, width, height):
+	for view in views[1:]:
+		store.release(file)
+	sheet = from_blob(held_blob(store, file))
+	return [(key, scaled(render(clone(sheet), edits), width, height)) for key, edits in views]
+
+class ThumbnailCache(object):
+
+	#ahead 0 makes it a plain cache, without a prefetching thread
+	def __init__(self, size=64, ahead=3):
+		self.size = size
+		self.ahead = ahead
+		self.items = OrderedDict()
+		self.lock = Lock()
+		self.pending = Queue()
+		if ahead:
+			worker = Thread(target=self.work)
+			worker.daemon = True
+			worker.start()
+
+	def get(self, key):
+		with self.lock:
+			img = self.items.pop(key, None)
+			if img is not None:
+				self.items[key] = img
+			return img
+
+	def put(self, key, img):
+		with self.lock:
+			self.items[key] = img
+			while len(self.items) > self.size:
+				self.items.popitem(last=False)
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+
+	#Through the store, which keeps the last decoded sheets and cards
+	def card(self, store, num, width, height):
+		key = (store.key(num), width, height)
+		img = self.get(key)
+		if img is None:
+			img = scaled(store[num], width, height)
+			self.put(key, img)
+		return img
+
+	#Only the latest request matters, older ones are dropped. Neighbours are
+	#queued by file, nearest first, so views of one sheet go together.
+	def prefetch(self, store, num, width, height):
+		while True:
+			try:
+				owner, file, views, size = self.pending.get_nowait()
+			except Empty:
+				break
+			for view in views:
+				owner.release(file)
+		files = OrderedDict()
+		for step in range(1, self.ahead+1):
+			for near in (num+step, num-step):
+				if 0 <= near < len(store):
+					key = (store.key(near), width, height)
+					if self.get(key) is None:
+						file, edits = store.hold(near)
+						files.setdefault(file, []).append((key, edits))
+		for file, views in files.items():
+			self.pending.put((store, file, views, (width, height)))
+
+	def work(self):
+		while True:
+			store, file, views, size = self.pending.get()
+			try:
+				#The preview may have rendered some meanwhile
+				todo = [view for view in views if self.get(view[0]) is None]
+				for view in views[len(todo):]:
+					store.release(file)
+				if todo:
+					for key, img in held_thumbnails(store, file, todo, *size):
+						self.put(key, img)
+			except Exception:
+				pass
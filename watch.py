@@ -0,0 +1,257 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Watch folder service: keeps the export of a recipe up to date with the
+card images and pdfs of a folder. The folder is polled, and a new, changed
+or removed file is only acted on once its size and modification time have
+held for the debounce interval, so files still being copied are left alone.
+
+Every file is loaded and run through the recipe steps on its own, and its
+cards are kept between rebuilds, so a change only loads and processes the
+files that changed (the disk cache also spares that after a restart).
+Pdf exports reuse the encoded cards of the last one, encoding only the
+cards that changed, and separated images skip the files that didn't
+change. The pdf export writes beside the final name and renames over it,
+so the last good one is always there.
+
+Settled changes go to the rebuilding loop through a bounded queue; while
+it is full they pile up in the watcher and go together in the next one.
+
+The recipe is batch.py's, without inputs:
+
+	{"steps": [["split", 3, 3, 10], ["trim", 20]],
+	 "output": {"format": "pdf", "path": "print/deck", "card_size": "Poker"}}
+
+Steps run on every file on its own, so a join never takes cards of two
+files. Cards follow the order of the file names.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import cpu_count
+from threading import Event, Thread
+try:
+	from Queue import Queue, Empty, Full
+except ImportError:
+	from queue import Queue, Empty, Full
+
+from store import CardStore
+from export import partial_path
+import batch
+
+EXTENSIONS = (".png", ".jpg", ".jpeg", ".pdf")
+#Seconds
+INTERVAL = 1.0
+DEBOUNCE = 2.0
+#Rebuilds waiting for the one running
+QUEUE = 1
+
+#{path: (size, mtime)} of the files that can be loaded; hidden files and
+#the ones in ignore (our own output) are left out
+def scan(folder, ignore=()):
+	found = {}
+	for name in os.listdir(folder):
+		path = os.path.join(folder, name)
+		if name.startswith(".") or not name.lower().endswith(EXTENSIONS) or path in ignore:
+			continue
+		try:
+			if os.path.isfile(path):
+				stat = os.stat(path)
+				found[path] = (stat.st_size, stat.st_mtime)
+		except OSError:
+			pass
+	return found
+
+#Polls the folder on a thread of its own and queues {path: state} of the
+#files that changed, state None for the removed ones
+class Watcher(object):
+
+	def __init__(self, folder, queue, interval=INTERVAL, debounce=DEBOUNCE, ignore=()):
+		self.folder = os.path.abspath(folder)
+		self.queue = queue
+		self.interval = interval
+		self.debounce = debounce
+		self.ignore = set(os.path.abspath(path) for path in ignore)
+		#What was last queued, files changing since when, and settled changes
+		#the queue had no room for
+		self.known = {}
+		self.changing = {}
+		self.pending = {}
+		self.stopped = Event()
+		self.thread = None
+
+	def poll(self, now=None):
+		now = time.time() if now is None else now
+		current = scan(self.folder, self.ignore)
+		for path in set(self.known) | set(self.changing) | set(current):
+			state = current.get(path)
+			if state == self.known.get(path):
+				self.changing.pop(path, None)
+				continue
+			seen, since = self.changing.get(path, (None, None))
+			if since is None or seen != state:
+				self.changing[path] = (state, now)
+			elif now - since >= self.debounce:
+				del self.changing[path]
+				self.pending[path] = state
+				if state is None:
+					self.known.pop(path, None)
+				else:
+					self.known[path] = state
+		if self.pending:
+			try:
+				self.queue.put_nowait(self.pending)
+				self.pending = {}
+			except Full:
+				pass
+
+	def run(self):
+		while not self.stopped.is_set():
+			try:
+				self.poll()
+			except OSError:
+				#The folder may be gone for a moment (network shares)
+				pass
+			self.stopped.wait(self.interval)
+
+	def start(self):
+		self.thread = Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread is not None:
+			self.thread.join()
+
+#Cards of every file, kept between rebuilds, and the export made from them
+class Service(object):
+
+	def __init__(self, recipe, use_pool=True, log=None, sheets=None):
+		self.steps = recipe.get("steps", [])
+		self.output = dict(recipe["output"])
+		self.pages = recipe.get("pages")
+		self.dpi = recipe.get("dpi")
+		self.use_pool = use_pool
+		self.log = log or (lambda text: None)
+		path = self.output["path"]
+		self.sheets = sheets or os.path.join(os.path.dirname(path), ".%s-sheets" % os.path.basename(path))
+		self.decks = {}
+
+	#Files the export writes, which must not be taken for input
+	def outputs(self):
+		path = self.output["path"] + ".pdf"
+		return [path, partial_path(path)]
+
+	#A file that fails to load keeps the cards it had, it is tried again
+	#once it changes
+	def update(self, path, state):
+		if state is None:
+			old = self.decks.pop(path, None)
+			if old is not None:
+				old.close()
+			self.log("%s: removed" % path)
+			return
+		deck = CardStore()
+		try:
+			batch.process(deck, [path], self.steps, dict(self.output, path=path), self.use_pool,
+					self.log, self.pages, self.dpi)
+			deck.bake_all()
+		except Exception as e:
+			deck.close()
+			self.log("%s: %s" % (path, e))
+			return
+		old = self.decks.pop(path, None)
+		if old is not None:
+			old.close()
+		self.decks[path] = deck
+
+	#One deck with the cards of every file, in file name order, sharing
+	#their files and hashes
+	def deck(self):
+		deck = CardStore()
+		for path in sorted(self.decks):
+			deck.extend_from(self.decks[path])
+		return deck
+
+	def rebuild(self, changes):
+		start = time.time()
+		for path in sorted(changes):
+			self.update(path, changes[path])
+		deck = self.deck()
+		try:
+			if len(deck) == 0:
+				self.log("No cards to export")
+				return
+			batch.export(deck, self.output, None, self.use_pool, self.sheets)
+			self.log("%s: %d cards from %d files, %d changed, in %.1fs" % (self.output["path"], len(deck),
+					len(self.decks), len(changes), time.time() - start))
+		finally:
+			deck.close()
+
+	def close(self):
+		for deck in self.decks.values():
+			deck.close()
+		self.decks = {}
+
+def serve(folder, recipe, interval=INTERVAL, debounce=DEBOUNCE, size=QUEUE, use_pool=True, log=None):
+	service = Service(recipe, use_pool, log)
+	queue = Queue(size)
+	watcher = Watcher(folder, queue, interval, debounce, service.outputs())
+	watcher.start()
+	try:
+		while True:
+			#A timeout keeps Ctrl+C working while waiting
+			try:
+				changes = queue.get(timeout=interval)
+			except Empty:
+				continue
+			#A failed export (a bad recipe, a full disk) is tried again with
+			#the next change
+			try:
+				service.rebuild(changes)
+			except Exception as e:
+				service.log("%s: export failed: %s" % (recipe["output"]["path"], e))
+	finally:
+		watcher.stop()
+		service.close()
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description="Rebuild the export of a folder of cards whenever it changes")
+	parser.add_argument("folder", help="folder with the card images and pdfs")
+	parser.add_argument("-r", "--recipe", required=True, help="JSON recipe file, as batch.py's without inputs")
+	parser.add_argument("--interval", type=float, default=INTERVAL, help="seconds between looks at the folder")
+	parser.add_argument("--debounce", type=float, default=DEBOUNCE, help="seconds a file must stay unchanged")
+	parser.add_argument("--queue", type=int, default=QUEUE, help="rebuilds that may wait for the running one")
+	parser.add_argument("--serial", action="store_true", help="don't use a process per core")
+	return parser.parse_args(argv)
+
+def main(argv):
+	args = parse_args(argv)
+	with open(args.recipe) as f:
+		recipe = json.load(f)
+	if "output" not in recipe or "path" not in recipe["output"]:
+		print("The recipe needs an output path", file=sys.stderr)
+		return 2
+	use_pool = not args.serial and cpu_count() > 1
+	def log(text):
+		print("%s %s" % (time.strftime("%H:%M:%S"), text))
+		sys.stdout.flush()
+	try:
+		serve(args.folder, recipe, args.interval, args.debounce, max(1, args.queue), use_pool, log)
+	except KeyboardInterrupt:
+		pass
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2016, Luis Javier Gonzalez (javi.gonzalez@zoho.com)
+
+This program is licensed under the GNU GPL 3.0 license.
+
+Separated images export. Every card becomes a file in the output folder,
+encoded and written by a pool of workers, so encoding one card overlaps
+writing another. The folder keeps a manifest of what every file was made
+from; exporting again skips the cards that didn't change without even
+encoding them, and a card that encodes to the bytes already on disk
+leaves its file untouched.
+"""
+
+import hashlib
+import json
+import os
+from multiprocessing import Pool, cpu_count
+
+from imaging import from_blob, to_blob, to_file
+from edits import render
+
+FORMATS = ("png", "jpg")
+MANIFEST = ".pnp-cards.json"
+
+#Runs in the workers, True if the file was written
+def _write(task):
+	blob, edits, path, format, quality, skip = task
+	data = to_file(render(from_blob(blob), edits), format, quality)
+	if skip and os.path.exists(path) and os.path.getsize(path) == len(data):
+		with open(path, "rb") as f:
+			if f.read() == data:
+				return False
+	with open(path + ".tmp", "wb") as f:
+		f.write(data)
+	os.rename(path + ".tmp", path)
+	return True
+
+class ImageWriter(object):
+
+	def __init__(self):
+		self.deck = None
+		self.print_path = None
+		self.format = "png"
+		self.quality = None
+		self.skip = True
+		self.parallel = False
+		self.written = 0
+
+	def config(self, deck=None, print_path=None, format=None, quality=None, skip=None, parallel=None):
+		if deck is not None:
+			self.deck = deck
+		if print_path is not None:
+			self.print_path = print_path
+		if format is not None:
+			if format not in FORMATS:
+				raise ValueError("Unknown image format %r" % format)
+			self.format = format
+		if quality is not None:
+			self.quality = quality
+		if skip is not None:
+			self.skip = skip
+		if parallel is not None:
+			self.parallel = parallel
+
+	def name(self, num):
+		return "%04d.%s" % (num + 1, self.format)
+
+	#What the file is made from. A CardStore card is known by its
+	#fingerprint and only read if it has to be written.
+	def key(self, num):
+		settings = "%s:%s" % (self.format, self.quality)
+		if hasattr(self.deck, "fingerprint"):
+			return self.deck.fingerprint(num) + settings
+		return hashlib.sha1(to_blob(self.deck[num])).hexdigest() + settings
+
+	def snapshot(self, num):
+		if hasattr(self.deck, "snapshot"):
+			return self.deck.snapshot(num)
+		return to_blob(self.deck[num]), []
+
+	def manifest(self):
+		try:
+			with open(os.path.join(self.print_path, MANIFEST)) as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return {}
+
+	def save_manifest(self, manifest):
+		path = os.path.join(self.print_path, MANIFEST)
+		with open(path + ".tmp", "w") as f:
+			json.dump(manifest, f, sort_keys=True)
+		os.rename(path + ".tmp", path)
+
+	#call is invoked once per file, written or skipped
+	def print_images(self, call=None):
+		if not os.path.isdir(self.print_path):
+			os.makedirs(self.print_path)
+		manifest = self.manifest()
+		todo = []
+		for num in range(len(self.deck)):
+			name = self.name(num)
+			key = self.key(num)
+			if self.skip and manifest.get(name) == key and os.path.exists(os.path.join(self.print_path, name)):
+				if call is not None:
+					call()
+				continue
+			#Until it is written again, the file is of nothing known
+			manifest.pop(name, None)
+			todo.append((num, name, key))
+		processes = cpu_count() if self.parallel else 1
+		pool = Pool(processes) if processes > 1 and len(todo) > 1 else None
+		self.written = 0
+		try:
+			#A few cards per worker in flight, so the blobs read stay few
+			window = 4*processes
+			for first in range(0, len(todo), window):
+				chunk = todo[first:first + window]
+				tasks = []
+				for num, name, key in chunk:
+					blob, edits = self.snapshot(num)
+					tasks.append((blob, edits, os.path.join(self.print_path, name), self.format, self.quality, self.skip))
+				results = pool.imap(_write, tasks) if pool is not None else map(_write, tasks)
+				for (num, name, key), written in zip(chunk, results):
+					manifest[name] = key
+					self.written += written
+					if call is not None:
+						call()
+			if pool is not None:
+				pool.close()
+		except:
+			if pool is not None:
+				pool.terminate()
+			raise
+		finally:
+			if pool is not None:
+				pool.join()
+			self.save_manifest(manifest)
+		#Files of cards the deck no longer has, only those this wrote
+		names = set(self.name(num) for num in range(len(self.deck)))
+		for name in list(manifest):
+			if name not in names:
+				path = os.path.join(self.print_path, name)
+				if os.path.exists(path):
+					os.remove(path)
+				del manifest[name]
+		self.save_manifest(manifest)